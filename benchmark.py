@@ -0,0 +1,142 @@
+# Rendering benchmark: python benchmark.py [--variants chess crazyhouse] [--output results.jsonl]
+# Every measurement is printed as one JSON object per line.
+import argparse
+import json
+import os
+import random
+import sys
+from statistics import median
+from time import perf_counter
+
+import pyffish as sf
+
+import board
+from board import DrawBoard
+from game import Game, VARIANTS
+
+
+def peak_rss():
+	# peak resident memory of this process in bytes
+	try:
+		import resource
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		return peak if sys.platform == 'darwin' else peak * 1024
+	except ImportError:
+		import ctypes, ctypes.wintypes
+
+		class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+			_fields_ = [('cb', ctypes.wintypes.DWORD), ('PageFaultCount', ctypes.wintypes.DWORD),
+						('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+						('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+						('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+						('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+		counters = PROCESS_MEMORY_COUNTERS()
+		counters.cb = ctypes.sizeof(counters)
+		ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+												 ctypes.byref(counters), counters.cb)
+		return counters.PeakWorkingSetSize
+
+
+def playout(variant, plies, rng, prefer_captures=False):
+	# a reproducible pseudo-random game, optionally grabbing material to fill up the pockets
+	fen = sf.start_fen(variant)
+	moves = []
+	for i in range(plies):
+		legal = sf.legal_moves(variant, fen, [], True)
+		if not legal:
+			break
+
+		move = rng.choice(legal)
+		if prefer_captures:
+			captures = [m for m in legal if 'x' in sf.get_san(variant, fen, m, True)]
+			if captures:
+				move = rng.choice(captures)
+
+		moves += [move]
+		fen = sf.get_fen(variant, fen, [move], True)
+	return fen, moves
+
+
+def sample_positions(variant, rng):
+	positions = [('start', sf.start_fen(variant), [])]
+	positions += [('middlegame', *playout(variant, 30, rng))]
+	positions += [('captures', *playout(variant, 60, rng, prefer_captures=True))]
+	return positions
+
+
+def bench_board(variant, kind, fen, moves, repeat):
+	settings = VARIANTS[variant]
+	lastmove = moves[-1] if moves else None
+
+	def drawing():
+		return DrawBoard(settings.board_type, settings.folder, False, False, settings.intersections,
+						 settings.invert_text, fen, lastmove)
+
+	start = perf_counter()
+	drawing().draw_board()
+	cold = perf_counter() - start
+
+	timings = []
+	for i in range(repeat):
+		start = perf_counter()
+		img = drawing().draw_board()
+		timings += [perf_counter() - start]
+
+	start = perf_counter()
+	encoded = drawing().render_board()
+	encode = perf_counter() - start - median(timings)
+
+	return {'benchmark': 'board', 'variant': variant, 'position': kind, 'fen': fen,
+			'size': list(img.size), 'cold_ms': round(cold*1000, 3), 'ms': round(median(timings)*1000, 3),
+			'encode_ms': round(max(encode, 0)*1000, 3), 'bytes': len(encoded), 'peak_rss': peak_rss()}
+
+
+def bench_clip(variant, plies, codec, rng):
+	fen, moves = playout(variant, plies, rng)
+	startpos = sf.start_fen(variant)
+	frames = len(moves) + 1 + (len(moves) > 0)
+
+	start = perf_counter()
+	clip = Game.render_moves(variant, startpos, moves, fen, codec=codec)
+	elapsed = perf_counter() - start
+
+	return {'benchmark': 'clip', 'variant': variant, 'codec': codec, 'plies': len(moves), 'frames': frames,
+			'ms': round(elapsed*1000, 3), 'ms_per_frame': round(elapsed*1000 / frames, 3),
+			'bytes': len(clip), 'peak_rss': peak_rss()}
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Measure board and clip rendering for every variant.')
+	parser.add_argument('--variants', nargs='*', default=Game.variants_list())
+	parser.add_argument('--repeat', type=int, default=10, help='warm renders per position')
+	parser.add_argument('--clip-plies', type=int, default=200, help='length of the synthetic clip games, 0 to skip')
+	parser.add_argument('--codecs', nargs='*', default=['mp4'])
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--variants-file', default=os.getenv('VARIANTS_LOCATION', 'variants.txt'))
+	parser.add_argument('--font', default=board.FONT_LOCATION)
+	parser.add_argument('--output', help='file to write the results to, instead of stdout')
+	args = parser.parse_args()
+
+	board.FONT_LOCATION = args.font
+	with open(args.variants_file, "r") as f:
+		sf.load_variant_config(f.read())
+
+	output = open(args.output, 'w') if args.output else sys.stdout
+
+	for variant in args.variants:
+		rng = random.Random(f"{args.seed}-{variant}")
+
+		for kind, fen, moves in sample_positions(variant, rng):
+			print(json.dumps(bench_board(variant, kind, fen, moves, args.repeat)), file=output, flush=True)
+
+		if args.clip_plies:
+			for codec in args.codecs:
+				print(json.dumps(bench_clip(variant, args.clip_plies, codec, rng)), file=output, flush=True)
+
+	if args.output:
+		output.close()
+
+
+if __name__ == '__main__':
+	main()
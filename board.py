@@ -1,5 +1,7 @@
 import PIL.Image, PIL.ImageDraw, PIL.ImageFont
-from re import findall
+from re import findall, fullmatch
+import os
+import io
 
 DARK = (181, 136, 99)
 LIGHT = (240, 217, 181)
@@ -17,9 +19,90 @@ IMGS_LOCATION = "graphics"
 
 FONT_LOCATION = r'C:\Windows\Fonts\ARLRDBD.ttf'
 
+# decoded piece images, keyed by (folder, piece, flipped, size)
+SPRITES = {}
+
+# custom board images, keyed by (folder, upside_down, square size)
+BOARD_IMAGES = {}
+
+# board backgrounds and coordinate overlays, keyed by board type and geometry
+LAYERS = {}
+
+FONTS = {}
+
+
+def load_font(size):
+	if size not in FONTS:
+		FONTS[size] = PIL.ImageFont.truetype(FONT_LOCATION, size)
+	return FONTS[size]
+
+
+def scale(img, sq_size):
+	# graphics are drawn for SQ_SIZE squares
+	width, height = img.size
+	return img.resize((round(width * sq_size / SQ_SIZE), round(height * sq_size / SQ_SIZE)), PIL.Image.LANCZOS)
+
+
+def load_sprite(folder, piece, flipped=False, sq_size=SQ_SIZE):
+	key = (folder, piece, flipped, sq_size)
+	if key in SPRITES:
+		return SPRITES[key]
+
+	if sq_size != SQ_SIZE:
+		sprite = scale(load_sprite(folder, piece, flipped), sq_size)
+	elif flipped:
+		sprite = load_sprite(folder, piece).rotate(180)
+	else:
+		if piece.lower() == piece:
+			colour = "b"
+		else:
+			colour = "w"
+
+		try:
+			sprite = PIL.Image.open(os.path.join(IMGS_LOCATION, folder, f'{colour}{piece.upper()}.png')).convert('RGBA')
+		except:
+			sprite = PIL.Image.open(os.path.join(IMGS_LOCATION, 'fail.png')).convert('RGBA')
+
+	SPRITES[key] = sprite
+	return sprite
+
+
+def load_board_image(folder, upside_down=False, sq_size=SQ_SIZE):
+	key = (folder, upside_down, sq_size)
+	if key in BOARD_IMAGES:
+		return BOARD_IMAGES[key]
+
+	if sq_size != SQ_SIZE:
+		board = scale(load_board_image(folder, upside_down), sq_size)
+	else:
+		board = PIL.Image.open(os.path.join(IMGS_LOCATION, folder, 'board.png'))
+		if upside_down:
+			board = board.rotate(180)
+
+	BOARD_IMAGES[key] = board
+	return board
+
+
+def preload_sprites(folder, flipped=False, pieces=None):
+	# only the given piece letters and their promoted forms, when pieces is set
+	for file_name in os.listdir(os.path.join(IMGS_LOCATION, folder)):
+		match = fullmatch(r'([wb])(\+?[A-Z]~?)\.png', file_name)
+		if not match:
+			continue
+
+		colour, piece = match.groups()
+		if colour == "b":
+			piece = piece.lower()
+		if pieces is not None and piece.strip('+~') not in pieces:
+			continue
+
+		load_sprite(folder, piece)
+		if flipped:
+			load_sprite(folder, piece, flipped=True)
+
 
 class DrawBoard:
-	def __init__(self, board_type, folder, flip_pieces, upside_down, intersections, invert_text, fen, lastmove):
+	def __init__(self, board_type, folder, flip_pieces, upside_down, intersections, invert_text, fen, lastmove, sq_size=SQ_SIZE):
 		self.board_type = board_type
 		self.folder = folder
 		self.flip_pieces = flip_pieces
@@ -28,6 +111,7 @@ class DrawBoard:
 		self.invert_text = invert_text
 		self.fen = fen
 		self.lastmove = lastmove
+		self.sq_size = sq_size
 
 	def flatten(self, some_list):
 		output = []
@@ -45,18 +129,10 @@ class DrawBoard:
 		else:
 			x = ALPHABET.index(square[0])
 			y = height - int(square[1:])
-		return [x*SQ_SIZE, y*SQ_SIZE]
-
-	def get_piece_img(self, piece):
-		if piece.lower() == piece:
-			colour = "b"
-		else:
-			colour = "w"
+		return [x*self.sq_size, y*self.sq_size]
 
-		try:
-			return PIL.Image.open(f'graphics\\{self.folder}\\{colour}{piece}.png').convert('RGBA')
-		except:
-			return PIL.Image.open(f'graphics\\fail.png').convert('RGBA')
+	def get_piece_img(self, piece, flipped=False):
+		return load_sprite(self.folder, piece, flipped, self.sq_size)
 
 	def fen_to_array(self):
 		fen_array = [findall('(\d+|\+?[a-zA-Z]\~?)', i) for i in self.fen.split(' ')[0].split('[')[0].split('/')]
@@ -79,74 +155,67 @@ class DrawBoard:
 		whitepcs = sorted([p for p in pocket if p.isupper()])
 		return (whitepcs, blackpcs)
 
-	def draw_board(self, stabilise_pocket=False):
-		pos = self.fen_to_array()
-		b_height = len(pos)
-		b_width = len(pos[0])
-
-		white_hand, black_hand = self.in_hand()
-		pocket_rows = 2 + (len(white_hand)-1) // b_height + (len(black_hand)-1) // b_height
-
-		# To make the game clip more stable, try to keep the pocket size at an even number
-		if stabilise_pocket and pocket_rows % 2 == 1:
-			pocket_rows += 1
+	def layers_key(self, img_size, b_width, b_height):
+		board_type = self.board_type
+		if isinstance(board_type, list): # lists can't be hashed
+			board_type = tuple(board_type)
+		elif board_type != "checkerboard" and not isinstance(board_type, tuple): # custom image
+			board_type = (board_type, self.folder)
 
-		spacer = 0
-		if pocket_rows:
-			spacer = round(SQ_SIZE*0.2)
+		return (board_type, self.sq_size, img_size, b_width, b_height, self.upside_down, self.intersections, self.invert_text)
 
-		img_size = (b_width*SQ_SIZE, (b_height + pocket_rows)*SQ_SIZE + spacer)
+	def get_layers(self, img_size, b_width, b_height):
+		key = self.layers_key(img_size, b_width, b_height)
+		if key not in LAYERS:
+			LAYERS[key] = (self.draw_background(img_size, b_width, b_height),
+						   self.draw_coordinates(b_width, b_height))
+		return LAYERS[key]
 
+	def draw_background(self, img_size, b_width, b_height):
 		img = PIL.Image.new(mode='RGB', size=img_size, color=GREY)
 		drw = PIL.ImageDraw.Draw(img, 'RGBA')
 
-		# BOARD
 		if self.board_type == "checkerboard": # chess style checkerboard
 			for i in range(b_height):
 				for j in range(b_width):
 					if (i+j) % 2 == 0:
-						drw.rectangle([j*SQ_SIZE, i*SQ_SIZE, (j+1)*SQ_SIZE, (i+1)*SQ_SIZE], fill=LIGHT)
+						drw.rectangle([j*self.sq_size, i*self.sq_size, (j+1)*self.sq_size, (i+1)*self.sq_size], fill=LIGHT)
 					else:
-						drw.rectangle([j*SQ_SIZE, i*SQ_SIZE, (j+1)*SQ_SIZE, (i+1)*SQ_SIZE], fill=DARK)
+						drw.rectangle([j*self.sq_size, i*self.sq_size, (j+1)*self.sq_size, (i+1)*self.sq_size], fill=DARK)
 
 		elif isinstance(self.board_type, list): # checkerboard with custom colours
 			for i in range(b_height):
 				for j in range(b_width):
 					if (i+j) % 2 == 0:
-						drw.rectangle([j*SQ_SIZE, i*SQ_SIZE, (j+1)*SQ_SIZE, (i+1)*SQ_SIZE], fill=self.board_type[0])
+						drw.rectangle([j*self.sq_size, i*self.sq_size, (j+1)*self.sq_size, (i+1)*self.sq_size], fill=self.board_type[0])
 					else:
-						drw.rectangle([j*SQ_SIZE, i*SQ_SIZE, (j+1)*SQ_SIZE, (i+1)*SQ_SIZE], fill=self.board_type[1])
+						drw.rectangle([j*self.sq_size, i*self.sq_size, (j+1)*self.sq_size, (i+1)*self.sq_size], fill=self.board_type[1])
 
 		elif isinstance(self.board_type, tuple): # shogi style board with a custom colour
-			border = round(SQ_SIZE*0.01)
-			drw.rectangle([0, 0, b_width*SQ_SIZE, b_height*SQ_SIZE], fill=self.board_type)
+			border = round(self.sq_size*0.01)
+			drw.rectangle([0, 0, b_width*self.sq_size, b_height*self.sq_size], fill=self.board_type)
 			for i in range(b_height-1):
-				drw.rectangle([0, SQ_SIZE*(i+1) - border, b_width*SQ_SIZE, SQ_SIZE*(i+1) + border], fill=BLACK)
+				drw.rectangle([0, self.sq_size*(i+1) - border, b_width*self.sq_size, self.sq_size*(i+1) + border], fill=BLACK)
 			for i in range(b_height-1):
-				drw.rectangle([SQ_SIZE*(i+1) - border, 0, SQ_SIZE*(i+1) + border, b_height*SQ_SIZE], fill=BLACK)
+				drw.rectangle([self.sq_size*(i+1) - border, 0, self.sq_size*(i+1) + border, b_height*self.sq_size], fill=BLACK)
 
 		else: # custom image
-			board = PIL.Image.open(f'graphics\\{self.folder}\\board.png')
-			if self.upside_down:
-				board = board.rotate(180)
-			img.paste(board, (0, 0))
+			img.paste(load_board_image(self.folder, self.upside_down, self.sq_size), (0, 0))
 
-		# HIGHLIGHTING
-		if self.lastmove:
-			for highlight in findall(r'[a-z]\d+', self.lastmove):
-				coords = self.square_to_coords(highlight, b_width, b_height)
-				highlight_coords = coords + [i+100 for i in coords]
-				if self.board_type == "checkerboard":
-					if sum(coords) % (SQ_SIZE*2) == 0:
-						drw.rectangle(highlight_coords, fill=LASTMOVE_LIGHT)
-					else:
-						drw.rectangle(highlight_coords, fill=LASTMOVE_DARK)
-				else:
-					drw.rectangle(highlight_coords, fill=GREEN)
+		# pocket separator
+		if img_size[1] > b_height*self.sq_size:
+			spacer = round(self.sq_size*0.2)
+			drw.rectangle([0, b_height*self.sq_size, b_width*self.sq_size, b_height*self.sq_size + spacer], fill=BLACK)
 
-		# LETTERS
-		font_size = SQ_SIZE*0.2
-		font = PIL.ImageFont.truetype(FONT_LOCATION, round(font_size))
+		return img
+
+	def draw_coordinates(self, b_width, b_height):
+		# transparent layer, so that it can go on top of the highlighting
+		img = PIL.Image.new(mode='RGBA', size=(b_width*self.sq_size, b_height*self.sq_size), color=(0, 0, 0, 0))
+		drw = PIL.ImageDraw.Draw(img)
+
+		font_size = self.sq_size*0.2
+		font = load_font(round(font_size))
 
 		ranks = [str(n+1) for n in range(b_height)]
 		if not self.upside_down:
@@ -157,8 +226,8 @@ class DrawBoard:
 			files = files[::-1]
 
 		if self.intersections:
-			h_offset = SQ_SIZE * 0.46
-			v_offset = SQ_SIZE * 0.31
+			h_offset = self.sq_size * 0.46
+			v_offset = self.sq_size * 0.31
 			r_anchor = "mm"
 			f_anchor = "mm"
 		else:
@@ -173,57 +242,164 @@ class DrawBoard:
 			text_colour = BLACK
 
 		for i in range(b_height):
-			drw.text((b_width*SQ_SIZE - font_size*0.1 - v_offset, i*SQ_SIZE + font_size*0.2 + h_offset),
+			drw.text((b_width*self.sq_size - font_size*0.1 - v_offset, i*self.sq_size + font_size*0.2 + h_offset),
 					  ranks[i], fill=text_colour, font=font, anchor=r_anchor)
 
 		for i in range(b_width):
-			drw.text((i*SQ_SIZE + font_size*0.1 + h_offset, b_height*SQ_SIZE - font_size*0.1 - v_offset),
+			drw.text((i*self.sq_size + font_size*0.1 + h_offset, b_height*self.sq_size - font_size*0.1 - v_offset),
 					  files[i], fill=text_colour, font=font, anchor=f_anchor)
 
+		return img
+
+	def highlighted_squares(self, b_width, b_height):
+		if not self.lastmove:
+			return []
+		return [tuple(self.square_to_coords(square, b_width, b_height)) for square in findall(r'[a-z]\d+', self.lastmove)]
+
+	# Compositing primitives, overridden by compositors that draw onto other kinds of images
+
+	def highlight_colour(self, coords):
+		if self.board_type == "checkerboard":
+			if sum(coords) % (self.sq_size*2) == 0:
+				return LASTMOVE_LIGHT
+			return LASTMOVE_DARK
+		return GREEN
+
+	def draw_highlight(self, img, coords):
+		highlight_coords = list(coords) + [i + self.sq_size - 1 for i in coords]
+		PIL.ImageDraw.Draw(img, 'RGBA').rectangle(highlight_coords, fill=self.highlight_colour(coords))
+
+	def draw_letters(self, img, coordinates, box=None):
+		if box is None:
+			img.paste(coordinates, (0, 0), coordinates)
+		else:
+			letters = coordinates.crop(box)
+			img.paste(letters, box, letters)
+
+	def draw_piece(self, img, piece, coords, flipped=False):
+		piece = self.get_piece_img(piece, flipped)
+		img.paste(piece, coords, piece)
+
+	def restore_area(self, img, background, box):
+		img.paste(background.crop(box), box)
+
+	def draw_pocket(self, img, b_width, b_height, spacer):
+		white_hand, black_hand = self.hands
+
+		white_pocket = [white_hand[i:i + b_width] for i in range(0, len(white_hand), b_width)]
+		for i in range(len(white_pocket)):
+			for j in range(len(white_pocket[i])):
+				self.draw_piece(img, white_pocket[i][j], (j*self.sq_size, (i+b_height)*self.sq_size + spacer))
+
+		black_pocket = [black_hand[i:i + b_width] for i in range(0, len(black_hand), b_width)]
+		for i in range(len(black_pocket)):
+			for j in range(len(black_pocket[i])):
+				self.draw_piece(img, black_pocket[i][j], (j*self.sq_size, (i+b_height+len(white_pocket))*self.sq_size + spacer))
+
+	def layout(self, stabilise_pocket=False):
+		self.pos = pos = self.fen_to_array()
+		b_height = len(pos)
+		b_width = len(pos[0])
+
+		self.hands = white_hand, black_hand = self.in_hand()
+		pocket_rows = 2 + (len(white_hand)-1) // b_height + (len(black_hand)-1) // b_height
+
+		# To make the game clip more stable, try to keep the pocket size at an even number
+		if stabilise_pocket and pocket_rows % 2 == 1:
+			pocket_rows += 1
+
+		return b_width, b_height, pocket_rows
+
+	def image_size(self, b_width, b_height, pocket_rows):
+		spacer = 0
+		if pocket_rows:
+			spacer = round(self.sq_size*0.2)
+
+		return (b_width*self.sq_size, (b_height + pocket_rows)*self.sq_size + spacer), spacer
+
+	def fit(self, width, height, stabilise_pocket=False):
+		# use the largest square size at which the whole image fits into width x height
+		b_width, b_height, pocket_rows = self.layout(stabilise_pocket)
+		rows = b_height + pocket_rows + 0.2*(pocket_rows > 0)
+		self.sq_size = max(int(min(width / b_width, height / rows)), 1)
+
+		while self.sq_size > 1 and self.image_size(b_width, b_height, pocket_rows)[0][1] > height:
+			self.sq_size -= 1
+
+	def draw_board(self, stabilise_pocket=False, previous=None):
+		# previous: the DrawBoard of the last frame; its image gets repainted in place
+		b_width, b_height, pocket_rows = self.layout(stabilise_pocket)
+		pos = self.pos
+
+		img_size, spacer = self.image_size(b_width, b_height, pocket_rows)
+		self.img_size = img_size
+		self.layers = self.layers_key(img_size, b_width, b_height)
+		background, coordinates = self.get_layers(img_size, b_width, b_height)
+		highlights = self.highlighted_squares(b_width, b_height)
+
+		if previous is not None and previous.layers == self.layers:
+			self.img = self.update_board(previous, background, coordinates, highlights, spacer)
+			return self.img
+
+		# BOARD
+		img = background.copy()
+
+		# HIGHLIGHTING
+		for coords in highlights:
+			self.draw_highlight(img, coords)
+
+		# LETTERS
+		self.draw_letters(img, coordinates)
+
 		# PIECES
 		for i in range(len(pos)):
 			for j in range(len(pos[i])):
 				if pos[i][j]:
-					piece = self.get_piece_img(pos[i][j])
-					if self.flip_pieces:
-						piece = piece.rotate(180)
-					img.paste(piece, (j*SQ_SIZE, i*SQ_SIZE), piece)
+					self.draw_piece(img, pos[i][j], (j*self.sq_size, i*self.sq_size), self.flip_pieces)
 
 		# POCKET
 		if pocket_rows:
-			drw.rectangle([0, b_height*SQ_SIZE, b_width*SQ_SIZE, b_height*SQ_SIZE + spacer], fill=BLACK)
+			self.draw_pocket(img, b_width, b_height, spacer)
 
-			white_pocket = [white_hand[i:i + b_width] for i in range(0, len(white_hand), b_width)]
-			for i in range(len(white_pocket)):
-				for j in range(len(white_pocket[i])):
-					piece = self.get_piece_img(white_pocket[i][j])
-					img.paste(piece, (j*SQ_SIZE, (i+b_height)*SQ_SIZE + spacer), piece)
+		self.img = img
+		return img
 
-			black_pocket = [black_hand[i:i + b_width] for i in range(0, len(black_hand), b_width)]
-			for i in range(len(black_pocket)):
-				for j in range(len(black_pocket[i])):
-					piece = self.get_piece_img(black_pocket[i][j])
-					img.paste(piece, (j*SQ_SIZE, (i+b_height+len(white_pocket))*SQ_SIZE + spacer), piece)
+	def update_board(self, previous, background, coordinates, highlights, spacer):
+		img = previous.img
+		previous.img = None
+		pos = self.pos
+		b_height = len(pos)
+		b_width = len(pos[0])
 
-		return img
+		# only squares whose piece or highlighting changed are repainted
+		changed = set(highlights) | set(previous.highlighted_squares(b_width, b_height))
+		for i in range(len(pos)):
+			for j in range(len(pos[i])):
+				if pos[i][j] != previous.pos[i][j]:
+					changed.add((j*self.sq_size, i*self.sq_size))
 
-	def render_board(self, img_name):
-		self.draw_board().save(img_name)
+		for x, y in changed:
+			box = (x, y, x + self.sq_size, y + self.sq_size)
+			self.restore_area(img, background, box)
+			if (x, y) in highlights:
+				self.draw_highlight(img, (x, y))
 
-	@staticmethod
-	def scale_to_fit(width, height, img):
-		# resize the board the maximum amount
-		prev_width, prev_height = img.size
-		resize_factor = min(width / prev_width, height / prev_height)
-		new_width, new_height = int(prev_width * resize_factor), int(prev_height * resize_factor)
+			self.draw_letters(img, coordinates, box)
 
-		scaled_img = img.resize((new_width, new_height), PIL.Image.ANTIALIAS)
+			piece = pos[y // self.sq_size][x // self.sq_size]
+			if piece:
+				self.draw_piece(img, piece, (x, y), self.flip_pieces)
 
-		# create a black background
-		resized = PIL.Image.new(mode='RGB', size=(width, height), color=BLACK)
+		if self.hands != previous.hands:
+			box = (0, b_height*self.sq_size + spacer) + self.img_size
+			self.restore_area(img, background, box)
+			self.draw_pocket(img, b_width, b_height, spacer)
 
-		# paste the board in the center of the black background
-		offset = ((width - new_width) // 2, (height - new_height) // 2)
-		resized.paste(scaled_img, offset)
+		return img
 
-		return resized
\ No newline at end of file
+	def render_board(self, output=None):
+		# output can be a file name or a file object; without one the PNG is returned as bytes
+		buffer = output or io.BytesIO()
+		self.draw_board().save(buffer, format='PNG')
+		if output is None:
+			return buffer.getvalue()
\ No newline at end of file
@@ -0,0 +1,156 @@
+# Opening book: python book.py [--variants chess crazyhouse] [--plies 4] [--output book.bin]
+# Searches the early tree of every variant from its start position at each skill band and
+# stores the engine's choices, so the bot can answer those positions without an engine.
+import argparse
+import asyncio
+import os
+import struct
+from hashlib import blake2b
+
+import pyffish as sf
+
+from engine import EnginePool, Scheduler, Limit
+from game import Game
+
+MAGIC = b'FSBK'
+VERSION = 1
+HEADER = struct.Struct('<4sBI') # magic, version, entry count
+ENTRY = struct.Struct('<QbHh') # position key, skill band, move index, eval
+SKILL_BANDS = (-20, -10, 0, 10, 20)
+MATE = 32000 # evals beyond MATE - 1000 are mates, MATE - n plies away
+
+
+def position_key(variant, fen):
+	# The move counters don't change the book move
+	position = ' '.join(fen.split()[:-2])
+	return int.from_bytes(blake2b(f"{variant} {position}".encode(), digest_size=8).digest(), 'little')
+
+
+def skill_band(skill):
+	return min(SKILL_BANDS, key=lambda band: abs(band - skill))
+
+
+def encode_eval(engine_eval):
+	kind, value = engine_eval.split()
+	value = int(value)
+	if kind == 'mate':
+		return MATE - value if value > 0 else -MATE - value
+	return max(min(value, MATE - 1001), 1001 - MATE)
+
+
+def decode_eval(value):
+	if value > MATE - 1000:
+		return f"mate {MATE - value}"
+	if value < 1000 - MATE:
+		return f"mate {-MATE - value}"
+	return f"cp {value}"
+
+
+class Book:
+	def __init__(self):
+		self.entries = {} # (position key, band): (move index, eval)
+
+	def add(self, variant, fen, skill, move, engine_eval):
+		# Moves are stored as their index among the sorted legal moves
+		legal = sorted(sf.legal_moves(variant, fen, [], True))
+		self.entries[(position_key(variant, fen), skill_band(skill))] = (legal.index(move), encode_eval(engine_eval))
+
+	def lookup(self, variant, fen, skill):
+		entry = self.entries.get((position_key(variant, fen), skill_band(skill)))
+		if entry is None:
+			return None
+		legal = sorted(sf.legal_moves(variant, fen, [], True))
+		move_index, value = entry
+		if move_index >= len(legal):
+			return None # hash collision with a different position
+		return (legal[move_index], decode_eval(value))
+
+	def save(self, file_name):
+		with open(file_name, 'wb') as f:
+			f.write(HEADER.pack(MAGIC, VERSION, len(self.entries)))
+			for (key, band), (move_index, value) in sorted(self.entries.items()):
+				f.write(ENTRY.pack(key, band, move_index, value))
+
+	@staticmethod
+	def load(file_name):
+		book = Book()
+		with open(file_name, 'rb') as f:
+			data = f.read()
+		magic, version, count = HEADER.unpack_from(data)
+		if magic != MAGIC or version != VERSION:
+			raise ValueError(f"{file_name} is not a version {VERSION} opening book")
+		for key, band, move_index, value in ENTRY.iter_unpack(data[HEADER.size:HEADER.size + count * ENTRY.size]):
+			book.entries[(key, band)] = (move_index, value)
+		return book
+
+
+def game_fen(variant, start, moves):
+	# Spelled the way Game.fen has it, start_fen and get_fen write castling rights differently
+	return sf.get_fen(variant, start, moves, True) if moves else start
+
+
+async def build_tree(pool, book, variant, skill, plies, movetime):
+	# The bot's side gets the engine move, the other side every legal reply
+	start = sf.start_fen(variant)
+	for bot_side in (0, 1):
+		frontier = {position_key(variant, start): []}
+		for ply in range(plies):
+			if ply % 2 == bot_side:
+				fens = {key: game_fen(variant, start, moves) for key, moves in frontier.items()}
+				todo = [key for key, fen in fens.items() if book.lookup(variant, fen, skill) is None]
+				results = await asyncio.gather(*[pool.analyze(variant, skill, 1, 64, start, frontier[key], Limit(movetime=movetime))
+												  for key in todo])
+				for key, (bestmove, engine_eval) in zip(todo, results):
+					if bestmove and bestmove != '(none)' and engine_eval:
+						book.add(variant, fens[key], skill, bestmove, engine_eval)
+
+				next_frontier = {}
+				for key, moves in frontier.items():
+					entry = book.lookup(variant, fens[key], skill)
+					if entry:
+						line = moves + [entry[0]]
+						next_frontier[position_key(variant, game_fen(variant, start, line))] = line
+				frontier = next_frontier
+			else:
+				next_frontier = {}
+				for moves in frontier.values():
+					for move in sf.legal_moves(variant, start, moves, True):
+						line = moves + [move]
+						next_frontier[position_key(variant, game_fen(variant, start, line))] = line
+				frontier = next_frontier
+
+
+async def build(args):
+	book = Book.load(args.output) if os.path.isfile(args.output) and not args.rebuild else Book()
+	pool = EnginePool(args.engine, args.variants_file, max_idle=args.jobs, scheduler=Scheduler(args.jobs, args.jobs * 64))
+	try:
+		for variant in args.variants:
+			for skill in args.skills:
+				await build_tree(pool, book, variant, skill, args.plies, args.movetime)
+				book.save(args.output)
+				print(f"{variant} skill {skill}: {len(book.entries)} entries")
+	finally:
+		await pool.close()
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Build the opening book the bot answers early moves from.')
+	parser.add_argument('--variants', nargs='*', default=Game.variants_list())
+	parser.add_argument('--skills', nargs='*', type=int, default=list(SKILL_BANDS))
+	parser.add_argument('--plies', type=int, default=4, help='depth of the tree from the start position')
+	parser.add_argument('--movetime', type=int, default=10000, help='ms per book move')
+	parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='engines searching at once')
+	parser.add_argument('--engine', default=os.getenv('ENGINE_LOCATION'))
+	parser.add_argument('--variants-file', default=os.getenv('VARIANTS_LOCATION', 'variants.txt'))
+	parser.add_argument('--output', default=os.getenv('BOOK_LOCATION', 'book.bin'))
+	parser.add_argument('--rebuild', action='store_true', help='ignore an existing book instead of extending it')
+	args = parser.parse_args()
+
+	with open(args.variants_file, "r") as f:
+		sf.load_variant_config(f.read())
+
+	asyncio.run(build(args))
+
+
+if __name__ == '__main__':
+	main()
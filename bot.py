@@ -1,4 +1,5 @@
 import os
+import io
 import discord
 import pyffish as sf
 import tinydb
@@ -8,37 +9,16 @@ from random import randint, sample
 import asyncio
 
 from game import Game
-from engine import Engine
-
-# ----------------------------------------------------------------
-# SETUP
-
-load_dotenv()
-
-TOKEN = os.getenv('DISCORD_TOKEN')
-BOT_NAME = os.getenv('BOT_NAME')
-ADMIN_NAME = os.getenv('ADMIN_NAME')
-ENGINE_LOCATION = os.getenv('ENGINE_LOCATION')
-VARIANTS_LOCATION = os.getenv('VARIANTS_LOCATION')
-BOT_ID = int(os.getenv('BOT_ID'))
+from engine import EnginePool, AnalysisCache, Scheduler, StopPolicy, PRIORITY_MOVE, PRIORITY_EVAL
+from renderer import Renderer
+from book import Book
+from review import Review, review_game
+import metrics
 
 client = discord.Client(activity=discord.Game(name='--help'))
 games_dict = {}
-allowed_variants = Game.variants_list()
-
-db = tinydb.TinyDB('saved_games.json')
-for game_records in db: # only 1 entry in DB
-	for channel, saved_game in game_records.items():
-		game = Game()
-		game.__dict__ = saved_game
-		games_dict[int(channel)] = game
-
-with open(VARIANTS_LOCATION, "r") as f:
-	ini_text = f.read()
-sf.load_variant_config(ini_text)
-Game.set_rules(ini_text)
-
-# ----------------------------------------------------------------
+review_tasks = set() # running reviews, referenced so they aren't garbage collected
+metrics_task = None # started by the first on_ready, which runs again on every reconnect
 
 
 def shuffle_fen(variant):
@@ -56,7 +36,7 @@ def shuffle_fen(variant):
 				if (setup.index('B') - setup[::-1].index('B')) % 2 == 0:
 					return f"{setup.lower()}/pppppppp/8/8/8/8/PPPPPPPP/{setup}[] w KQkq - 0 1"
 
-	return sf.start_fen(variant)
+	return Game.start_fen(variant)
 
 
 def decriptive_eval(engine_eval, white_to_play):
@@ -79,6 +59,7 @@ def decriptive_eval(engine_eval, white_to_play):
 async def game_over(message, result):
 	game = games_dict[message.channel.id]
 	game.active = False
+	await engine_pool.stop_pondering((message.channel.id, game.start))
 
 	result_text, result_code = {'White': (f"{game.wplayer} wins.", "1-0"),
 								'Black': (f"{game.bplayer} wins.", "0-1"),
@@ -94,26 +75,60 @@ async def game_over(message, result):
 	await message.channel.send(output)
 	await display_clip(message, game)
 
+	if REVIEW_BUDGET and len(game.moves) >= 2:
+		task = asyncio.create_task(post_review(message, game))
+		review_tasks.add(task)
+		task.add_done_callback(review_tasks.discard)
+
 	return
 
 
+async def post_review(message, game):
+	# Runs in the background after game over, editing one message as plies are evaluated
+	review = Review(game.variant, game.startpos, list(game.moves), game.wplayer, game.bplayer, game.get_moves())
+	review_message = await message.channel.send(f"**Game review** (0/{len(review.moves)} plies, analysing...)")
+	last_edit = asyncio.get_running_loop().time()
+
+	async def show_progress(review):
+		nonlocal last_edit
+		now = asyncio.get_running_loop().time()
+		if now - last_edit >= 3: # stay clear of Discord's edit rate limit
+			last_edit = now
+			await review_message.edit(content=review.summary())
+
+	owner = message.guild.id if message.guild else message.channel.id
+	try:
+		await review_game(engine_pool, review, REVIEW_BUDGET, owner=owner, on_progress=show_progress)
+	finally:
+		# Show what was evaluated even if the review failed part way
+		review.finished = True
+		await review_message.edit(content=review.summary())
+
+
 async def bot_makes_move(message):
 	game = games_dict[message.channel.id]
 
 	# Get a best move from Fairy-Stockfish
-	engine = Engine(ENGINE_LOCATION, VARIANTS_LOCATION, game.variant, game.bot_skill)
+	game_key = (message.channel.id, game.start)
+	owner = message.guild.id if message.guild else message.channel.id
+
+	started = asyncio.get_running_loop().time()
+	book_move = None if game.is_selfplay() else book.lookup(game.variant, game.fen, game.bot_skill) # selfplay games should vary
 
-	if game.is_selfplay():
-		await engine.allocate(threads=12, memory=4096)
-		bestmove, engine_eval = await engine.analyze(game.startpos, game.moves, 60000)
+	if book_move:
+		bestmove, engine_eval = analysis = book_move
+	elif game.is_selfplay():
+		bestmove, engine_eval = analysis = await engine_pool.analyze(game.variant, game.bot_skill, 12, 4096, game.startpos, game.moves, 60000, game_key,
+														             priority=PRIORITY_MOVE, owner=owner, policy=stop_policy)
 	elif game.bot_skill == 20:
-		await engine.allocate(threads=6, memory=1024)
-		bestmove, engine_eval = await engine.analyze(game.startpos, game.moves, 30000)
+		bestmove, engine_eval = analysis = await engine_pool.analyze(game.variant, game.bot_skill, 6, 1024, game.startpos, game.moves, 30000, game_key,
+														             ponder=True, priority=PRIORITY_MOVE, owner=owner, policy=stop_policy)
 	else:
-		await engine.allocate(threads=1, memory=256)
-		bestmove, engine_eval = await engine.analyze(game.startpos, game.moves, 5000)
+		bestmove, engine_eval = analysis = await engine_pool.analyze(game.variant, game.bot_skill, 1, 256, game.startpos, game.moves, 5000, game_key,
+														             priority=PRIORITY_MOVE, owner=owner, policy=stop_policy)
 
-	await engine.quit()
+	source = 'book' if book_move else 'cache' if analysis.cached else 'engine'
+	metrics.BOT_MOVE_SECONDS.observe(asyncio.get_running_loop().time() - started, source=source)
 
 	mating_line = engine_eval.split()[0] == 'mate' and int(engine_eval.split()[1]) == -1
 	# cp_losing = engine_eval.split()[0] == 'cp' and int(engine_eval.split()[1]) <= 3000
@@ -133,22 +148,23 @@ async def bot_makes_move(message):
 		await message.channel.send("--offerdraw")
 		return
 
-	bot_move = sf.get_san(game.variant, game.fen, bestmove, True)
+	bot_move = game.san(bestmove)
 	eval_text = decriptive_eval(engine_eval, game.turn() == 'White')
 
 	await message.channel.send(f"--m {bot_move} ||{eval_text}||")
 	return
 
 
-async def display_board(message, game_object):
-	img_name = "imgs\\board_" + str(message.channel.id) + '.png'
-	await message.channel.send(file=discord.File(game_object.render(img_name)))
+async def display_board(message, game_object, ply=None):
+	img = await renderer.render(game_object, ply=ply)
+	await message.channel.send(file=discord.File(io.BytesIO(img), filename='board.png'))
 	return
 
 
 async def display_clip(message, game_object):
-	clip_name = "imgs\\clip_" + str(message.channel.id) + '.mp4'
-	await message.channel.send(file=discord.File(game_object.render_clip(clip_name)))
+	clip = await renderer.render_clip(game_object, CLIP_FORMAT)
+	extension = 'png' if CLIP_FORMAT == 'apng' else CLIP_FORMAT
+	await message.channel.send(file=discord.File(io.BytesIO(clip), filename=f'clip.{extension}'))
 	return
 
 
@@ -160,6 +176,10 @@ async def on_ready():
 		print(f"{guild.name} [{guild.id}]")
 	print()
 
+	global metrics_task
+	if METRICS_LOG and metrics_task is None:
+		metrics_task = asyncio.create_task(metrics.log_json(METRICS_LOG, METRICS_INTERVAL))
+
 
 @client.event
 async def on_message(message):
@@ -176,7 +196,7 @@ async def on_message(message):
 				  "\n--rematch"
 				  "\n--move [move]"
 				  "\n--premove [move]"
-				  "\n--display"
+				  "\n--display [ply] (shows the position after that many moves)"
 				  "\n--offerdraw"
 				  "\n--acceptdraw"
 				  "\n--resign"
@@ -213,7 +233,7 @@ async def on_message(message):
 
 		# Validate FEN
 		if not input_fen:
-			input_fen = sf.start_fen(variant)
+			input_fen = Game.start_fen(variant)
 		else:
 			# Chess960
 			if input_fen == "shuffle":
@@ -268,7 +288,7 @@ async def on_message(message):
 			input_fen = fen_search[0]
 
 			if not input_fen:
-				input_fen = sf.start_fen(variant)
+				input_fen = Game.start_fen(variant)
 			elif input_fen == "shuffle": # Shuffle back rank pieces
 				input_fen = shuffle_fen(variant)
 
@@ -278,7 +298,7 @@ async def on_message(message):
 				await message.channel.send("Invalid FEN.")
 				return
 		else:
-			start_fen = sf.start_fen(variant)
+			start_fen = Game.start_fen(variant)
 
 		# Create game
 		# if side is not specified, choose randomly
@@ -429,6 +449,23 @@ async def on_message(message):
 		await message.channel.send(output)
 		return
 
+	# Display an earlier position of the game
+	if message_text.startswith('--display ') or message_text.startswith('--d '):
+		if not (game and game.active):
+			await message.channel.send("No game is active.")
+			return
+
+		ply = message_text.split()[1]
+		if not ply.isdigit() or int(ply) > len(game.moves):
+			await message.channel.send(f"Ply must be between 0 and {len(game.moves)}.")
+			return
+
+		ply = int(ply)
+		await display_board(message, game, ply)
+		await message.channel.send(f"Position after {ply} plies{': ' + game.get_moves()[ply - 1] if ply else ''}"
+								   f"\nFEN: {game.fen_at(ply)}")
+		return
+
 	# Resign an ongoing game
 	if message_text == '--resign':
 		if not (game and game.active):
@@ -579,14 +616,18 @@ async def on_message(message):
 			return
 
 		# Get a best move from Fairy-Stockfish
-		engine = Engine(ENGINE_LOCATION, VARIANTS_LOCATION, game.variant, 20)
-		if username == ADMIN_NAME:
-			await engine.allocate(threads=6, memory=2048)
-			bestmove, engine_eval = await engine.analyze(game.startpos, game.moves, 30000)
-		else:
-			await engine.allocate(threads=1, memory=256)
-			bestmove, engine_eval = await engine.analyze(game.startpos, game.moves, 5000)
-		await engine.quit()
+		game_key = (message.channel.id, game.start)
+		owner = message.guild.id if message.guild else message.channel.id
+		try:
+			if username == ADMIN_NAME:
+				bestmove, engine_eval = await engine_pool.analyze(game.variant, 20, 6, 2048, game.startpos, game.moves, 30000, game_key,
+																  priority=PRIORITY_EVAL, owner=owner, max_wait=EVAL_WAIT)
+			else:
+				bestmove, engine_eval = await engine_pool.analyze(game.variant, 20, 1, 256, game.startpos, game.moves, 5000, game_key,
+																  priority=PRIORITY_EVAL, owner=owner, max_wait=EVAL_WAIT)
+		except asyncio.TimeoutError:
+			await message.channel.send("The engines are busy right now, try --eval again later.")
+			return
 
 		await message.channel.send(f"||{decriptive_eval(engine_eval, game.turn() == 'White')}||")
 		return
@@ -604,14 +645,29 @@ async def on_message(message):
 	# Save current games
 	if message_text == '--save' and username == ADMIN_NAME:
 		db.truncate()
-		db.insert({key: games_dict[key].__dict__ for key in games_dict}) # convert games to dict
+		db.insert({key: games_dict[key].to_dict() for key in games_dict}) # convert games to dict
 		await message.channel.send("Saved current games.")
 		return
 
 	# Game debug info
 	if message_text == '--repr' and username == ADMIN_NAME:
 		if game:
-			await message.channel.send(game.__dict__)
+			await message.channel.send(game.to_dict())
+		return
+
+	# Rendered image cache info
+	if message_text == '--renderstats' and username == ADMIN_NAME:
+		stats = renderer.cache.stats()
+		await message.channel.send(', '.join(f"{key}: {value}" for key, value in stats.items()))
+		return
+
+	if message_text == '--metrics' and username == ADMIN_NAME:
+		await message.channel.send(file=discord.File(io.BytesIO(metrics.prometheus().encode()), filename='metrics.txt'))
+		return
+
+	if message_text == '--enginestats' and username == ADMIN_NAME:
+		stats = engine_pool.stats()
+		await message.channel.send(', '.join(f"{key}: {value}" for key, value in stats.items()))
 		return
 
 	# Prematurely end a game
@@ -642,4 +698,48 @@ async def on_message(message):
 async def on_error(event, *args, **kwargs):
 	raise
 
-client.run(TOKEN)
\ No newline at end of file
+# ----------------------------------------------------------------
+# SETUP
+
+# Spawned render workers re-import this module as __mp_main__, so the setup below
+# (engines, database, caches, the book) only runs in the parent process
+if __name__ == '__main__':
+	load_dotenv()
+
+	TOKEN = os.getenv('DISCORD_TOKEN')
+	BOT_NAME = os.getenv('BOT_NAME')
+	ADMIN_NAME = os.getenv('ADMIN_NAME')
+	ENGINE_LOCATION = os.getenv('ENGINE_LOCATION')
+	VARIANTS_LOCATION = os.getenv('VARIANTS_LOCATION')
+	VARIANTS_SNAPSHOT = os.getenv('VARIANTS_SNAPSHOT') # variant registry cached for faster startup, optional
+	BOT_ID = int(os.getenv('BOT_ID'))
+	CLIP_FORMAT = os.getenv('CLIP_FORMAT', 'mp4') # mp4, gif, webp or apng
+	ENGINE_IDLE = int(os.getenv('ENGINE_IDLE', 4)) # engines kept running between searches
+	ANALYSIS_CACHE = os.getenv('ANALYSIS_CACHE') # file for engine results to survive restarts, optional
+	ENGINE_CORES = int(os.getenv('ENGINE_CORES', os.cpu_count())) # threads shared by all searches
+	ENGINE_HASH = int(os.getenv('ENGINE_HASH', 8192)) # MB of hash shared by all searches
+	BOOK_LOCATION = os.getenv('BOOK_LOCATION', 'book.bin') # built by book.py
+	REVIEW_BUDGET = int(os.getenv('REVIEW_BUDGET', 60)) # seconds of engine time per post-game review, 0 to disable
+	EVAL_WAIT = int(os.getenv('EVAL_WAIT', 30)) # seconds an --eval waits for engine capacity before giving up
+	METRICS_LOG = os.getenv('METRICS_LOG') # file for a json line of metrics every METRICS_INTERVAL seconds, optional
+	METRICS_INTERVAL = int(os.getenv('METRICS_INTERVAL', 300))
+
+	allowed_variants = Game.variants_list()
+
+	with open(VARIANTS_LOCATION, "r") as f:
+		ini_text = f.read()
+	sf.load_variant_config(ini_text)
+	Game.load_variants(ini_text, VARIANTS_SNAPSHOT)
+
+	db = tinydb.TinyDB('saved_games.json')
+	for game_records in db: # only 1 entry in DB, loaded after the variants so start positions are known
+		for channel, saved_game in game_records.items():
+			games_dict[int(channel)] = Game.from_dict(saved_game)
+
+	renderer = Renderer(ini_text)
+	engine_pool = EnginePool(ENGINE_LOCATION, VARIANTS_LOCATION, ENGINE_IDLE, AnalysisCache(file_name=ANALYSIS_CACHE),
+							 scheduler=Scheduler(ENGINE_CORES, ENGINE_HASH))
+	stop_policy = StopPolicy() # bot moves stop early on a single reply, a forced mate or a stable best move
+	book = Book.load(BOOK_LOCATION) if os.path.isfile(BOOK_LOCATION) else Book()
+
+	client.run(TOKEN)
@@ -1,8 +1,21 @@
 import cv2
 import numpy as np
+import PIL.Image, PIL.GifImagePlugin
+import tempfile
+import os
+import io
+
+GIF_TRANSPARENT = 255 # palette index
 
 class GameClip:
-	def __init__(self, width, height, fps, clip_name):
+	def __init__(self, width, height, fps, clip_name=None):
+		# OpenCV can only write videos to a path, so in-memory clips go through a private temp file
+		self.in_memory = clip_name is None
+		if self.in_memory:
+			handle, clip_name = tempfile.mkstemp(suffix='.mp4')
+			os.close(handle)
+		self.clip_name = clip_name
+
 		# I can't find a working codec
 		# self.fourcc = cv2.VideoWriter_fourcc(*'mp4v')
 		
@@ -12,6 +25,104 @@ class GameClip:
 	def add_img(self, PIL_img, frames=1):
 		for i in range(frames):
 			self.clip.write(cv2.cvtColor(np.array(PIL_img), cv2.COLOR_RGB2BGR))
+
+	def add_frame(self, BGR_array, frames=1):
+		for i in range(frames):
+			self.clip.write(BGR_array)
 	
 	def save(self):
-		self.clip.release()
\ No newline at end of file
+		self.clip.release()
+		if not self.in_memory:
+			return self.clip_name
+
+		with open(self.clip_name, 'rb') as f:
+			data = f.read()
+		os.remove(self.clip_name)
+		return data
+
+
+class AnimatedClip:
+	# GIF, WebP or APNG clip, encoded in memory.
+	# Only the part of each frame that changed is kept, and unchanged frames just extend the previous one.
+	def __init__(self, width, height, fps, clip_name=None, codec='webp'):
+		self.codec = codec
+		self.clip_name = clip_name
+		self.frame_duration = 1000 // fps
+		self.frames = [] # [image, offset, duration]
+		self.previous = None
+		self.palette = None
+
+	def changed_area(self, BGR_array):
+		# bounding box of the pixels that differ from the previous frame, and a mask of those pixels
+		if self.previous is None or self.previous.shape != BGR_array.shape:
+			return (0, 0, BGR_array.shape[1], BGR_array.shape[0]), None
+
+		changed = np.any(BGR_array != self.previous, axis=2)
+		rows = np.flatnonzero(changed.any(axis=1))
+		if not rows.size:
+			return None, None
+		cols = np.flatnonzero(changed.any(axis=0))
+		return (cols[0], rows[0], cols[-1] + 1, rows[-1] + 1), changed
+
+	def add_frame(self, BGR_array, frames=1):
+		duration = self.frame_duration * frames
+		box, changed = self.changed_area(BGR_array)
+		if box is None:
+			self.frames[-1][2] += duration
+			return
+
+		x0, y0, x1, y1 = box
+		region = PIL.Image.fromarray(np.ascontiguousarray(BGR_array[y0:y1, x0:x1, ::-1]))
+
+		if self.codec == 'gif':
+			# every frame is mapped onto the palette of the first one, with the last entry kept for transparency
+			if self.palette is None:
+				self.palette = region.quantize(colors=GIF_TRANSPARENT, method=PIL.Image.Quantize.MEDIANCUT)
+			region = region.quantize(palette=self.palette, dither=PIL.Image.Dither.NONE)
+
+			# pixels that didn't change inside the box are left transparent, which compresses much better
+			if changed is not None:
+				indices = np.array(region)
+				indices[~changed[y0:y1, x0:x1]] = GIF_TRANSPARENT
+				region = PIL.Image.fromarray(indices, mode='P')
+				region.putpalette(self.palette.getpalette())
+
+		self.frames.append([region, (x0, y0), duration])
+		self.previous = BGR_array
+
+	def full_frames(self):
+		canvas = self.frames[0][0].copy()
+		for region, offset, duration in self.frames:
+			canvas.paste(region, offset)
+			yield canvas.copy()
+
+	def save(self):
+		output = io.BytesIO()
+		durations = [duration for region, offset, duration in self.frames]
+
+		if self.codec == 'gif':
+			# written frame by frame, so each GIF frame only covers its changed rectangle
+			header, _ = PIL.GifImagePlugin.getheader(self.frames[0][0], info={'loop': 0})
+			for chunk in header:
+				output.write(chunk)
+			for region, offset, duration in self.frames:
+				for chunk in PIL.GifImagePlugin.getdata(region, offset, duration=duration, disposal=1, transparency=GIF_TRANSPARENT):
+					output.write(chunk)
+			output.write(b';')
+
+		elif self.codec == 'webp':
+			# Pillow's WebP writer also gathers the full frames into a list; the encoder finds the changed sub-rectangles itself
+			frames = list(self.full_frames())
+			frames[0].save(output, format='WEBP', save_all=True, append_images=frames[1:], duration=durations, loop=0, quality=80)
+
+		else:
+			# Pillow's APNG writer needs the frames as a list; it crops each one to its changed area
+			frames = list(self.full_frames())
+			frames[0].save(output, format='PNG', save_all=True, append_images=frames[1:], duration=durations, loop=0)
+
+		if self.clip_name is None:
+			return output.getvalue()
+
+		with open(self.clip_name, 'wb') as f:
+			f.write(output.getvalue())
+		return self.clip_name
\ No newline at end of file
@@ -0,0 +1,83 @@
+import cv2
+import numpy as np
+
+from board import DrawBoard, BLACK
+
+# sprites and board layers as numpy arrays, keyed the same way as their PIL counterparts
+ARRAY_SPRITES = {}
+ARRAY_LAYERS = {}
+
+
+def to_blend(rgba_img):
+	# premultiplied BGR colour and inverse alpha, so blending is a single multiply-add
+	array = np.asarray(rgba_img, dtype=np.float32)
+	alpha = array[..., 3:] / 255
+	return (array[..., 2::-1] * alpha, 1 - alpha)
+
+
+def blend(region, layer):
+	colour, inverse_alpha = layer
+	np.copyto(region, region * inverse_alpha + colour + 0.5, casting='unsafe')
+
+
+class ArrayBoard(DrawBoard):
+	# Draws BGR numpy frames that can be written straight to a cv2.VideoWriter
+
+	def get_layers(self, img_size, b_width, b_height):
+		key = self.layers_key(img_size, b_width, b_height)
+		if key not in ARRAY_LAYERS:
+			background, coordinates = DrawBoard.get_layers(self, img_size, b_width, b_height)
+			ARRAY_LAYERS[key] = (cv2.cvtColor(np.asarray(background), cv2.COLOR_RGB2BGR), to_blend(coordinates))
+		return ARRAY_LAYERS[key]
+
+	def get_piece_img(self, piece, flipped=False):
+		key = (self.folder, piece, flipped, self.sq_size)
+		if key not in ARRAY_SPRITES:
+			ARRAY_SPRITES[key] = to_blend(DrawBoard.get_piece_img(self, piece, flipped))
+		return ARRAY_SPRITES[key]
+
+	def draw_highlight(self, img, coords):
+		x, y = coords
+		region = img[y:y + self.sq_size, x:x + self.sq_size]
+		colour = self.highlight_colour(coords)
+		if len(colour) == 4:
+			alpha = colour[3] / 255
+			np.copyto(region, region * (1 - alpha) + np.array(colour[2::-1]) * alpha + 0.5, casting='unsafe')
+		else:
+			region[:] = colour[::-1]
+
+	def draw_letters(self, img, coordinates, box=None):
+		colour, inverse_alpha = coordinates
+		if box is None:
+			height, width = inverse_alpha.shape[:2]
+			blend(img[:height, :width], coordinates)
+		else:
+			x0, y0, x1, y1 = box
+			blend(img[y0:y1, x0:x1], (colour[y0:y1, x0:x1], inverse_alpha[y0:y1, x0:x1]))
+
+	def draw_piece(self, img, piece, coords, flipped=False):
+		x, y = coords
+		colour, inverse_alpha = self.get_piece_img(piece, flipped)
+		region = img[y:y + inverse_alpha.shape[0], x:x + inverse_alpha.shape[1]]
+
+		# like PIL's paste, anything outside the image is cut off
+		height, width = region.shape[:2]
+		blend(region, (colour[:height, :width], inverse_alpha[:height, :width]))
+
+	def restore_area(self, img, background, box):
+		x0, y0, x1, y1 = box
+		img[y0:y1, x0:x1] = background[y0:y1, x0:x1]
+
+	def draw_frame(self, width, height, previous=None):
+		# drawn at the largest square size that fits, then centred on a black frame
+		self.fit(width, height, stabilise_pocket=True)
+		img = self.draw_board(stabilise_pocket=True, previous=previous)
+
+		frame = np.empty((height, width, 3), dtype=np.uint8)
+		frame[:] = BLACK[::-1]
+
+		img_height, img_width = img.shape[:2]
+		x, y = (width - img_width) // 2, (height - img_height) // 2
+		frame[y:y + img_height, x:x + img_width] = img
+
+		return frame
\ No newline at end of file
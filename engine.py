@@ -1,64 +1,779 @@
-import subprocess
-from re import findall
+from contextlib import asynccontextmanager
+from collections import OrderedDict
+import pyffish as sf
 import asyncio
+import json
 import os
 
+import metrics
+
+class EngineError(Exception):
+	pass
+
+READY_TIMEOUT = 30 # seconds to answer isready, covers loading variants and NNUE
+SEARCH_MARGIN = 10 # seconds past movetime before a search is considered hung
+MAX_SEARCH = 300 # seconds allowed for depth or node limited searches
+PONDER_CAP = 4 # movetimes a ponder may run before the game counts as abandoned
+INFO_INTEGERS = {'depth', 'seldepth', 'multipv', 'nodes', 'nps', 'time', 'hashfull', 'tbhits', 'currmovenumber'}
+
+class Info:
+	# One "info" line of UCI output
+	def __init__(self):
+		self.depth = None
+		self.seldepth = None
+		self.multipv = 1
+		self.score = None # ('cp', N) or ('mate', N), from the side to move
+		self.bound = None # 'lowerbound', 'upperbound' or None when exact
+		self.nodes = None
+		self.nps = None
+		self.time = None
+		self.hashfull = None
+		self.tbhits = None
+		self.currmove = None
+		self.currmovenumber = None
+		self.pv = []
+
+	@staticmethod
+	def parse(line):
+		tokens = line.split()
+		if len(tokens) < 2 or tokens[0] != 'info' or tokens[1] == 'string':
+			return None
+		info = Info()
+		i = 1
+		while i < len(tokens):
+			key = tokens[i]
+			if key == 'string':
+				break
+			elif key == 'pv':
+				info.pv = tokens[i+1:]
+				break
+			elif key == 'score':
+				info.score = (tokens[i+1], int(tokens[i+2]))
+				i += 3
+				if i < len(tokens) and tokens[i] in ('lowerbound', 'upperbound'):
+					info.bound = tokens[i]
+					i += 1
+				continue
+			elif key in INFO_INTEGERS:
+				setattr(info, key, int(tokens[i+1]))
+				i += 1
+			elif key == 'currmove':
+				info.currmove = tokens[i+1]
+				i += 1
+			i += 1
+		return info
+
+	def eval(self):
+		return f"{self.score[0]} {self.score[1]}" if self.score else None
+
+
+class Limit:
+	# Search limits for go, any combination of them. Times are in ms.
+	def __init__(self, movetime=None, depth=None, nodes=None, wtime=None, btime=None, winc=None, binc=None, movestogo=None):
+		self.movetime = movetime
+		self.depth = depth
+		self.nodes = nodes
+		self.wtime = wtime
+		self.btime = btime
+		self.winc = winc
+		self.binc = binc
+		self.movestogo = movestogo
+
+	def go(self):
+		return ' '.join(f"{key} {value}" for key, value in vars(self).items() if value is not None)
+
+	def budget(self, white=True):
+		# Rough time the engine may spend on this move, None if unbounded by time
+		clock = self.wtime if white else self.btime
+		if clock is None:
+			return self.movetime
+		estimate = clock / (self.movestogo or 30) + ((self.winc if white else self.binc) or 0)
+		return min(estimate, self.movetime) if self.movetime else estimate
+
+
+class StopPolicy:
+	# When a search can stop before its limit without changing the move played
+	def __init__(self, min_depth=12, stable_depths=6, min_fraction=0.25):
+		self.min_depth = min_depth
+		self.stable_depths = stable_depths # iterations in a row with the same best move
+		self.min_fraction = min_fraction # of the time budget spent before trusting a stable pv
+
+	def check(self, analysis, legal_moves, elapsed, budget):
+		info = analysis.info()
+		if info is None or info.bound or not info.depth:
+			return None
+		if legal_moves == 1:
+			return 'single reply'
+		if info.score[0] == 'mate' and info.depth >= 2 * abs(info.score[1]):
+			return 'forced mate'
+		if budget and elapsed < budget * self.min_fraction:
+			return None
+		if info.depth >= self.min_depth and analysis.stable >= self.stable_depths:
+			return 'stable pv'
+		return None
+
+
+class Analysis:
+	# Result of a search, unpacks as (bestmove, eval) like the old tuple
+	def __init__(self):
+		self.bestmove = None
+		self.ponder = None
+		self.lines = {} # latest scored info per multipv
+		self.depth = 0
+		self.seldepth = 0
+		self.nodes = 0
+		self.nps = 0
+		self.time = 0
+		self.stable = 0 # consecutive depths with the same best move
+		self.stopped = None # reason for stopping early, if any
+		self.cached = False
+
+	def update(self, info):
+		for key in ('depth', 'seldepth', 'nodes', 'nps', 'time'):
+			value = getattr(info, key)
+			if value is not None:
+				setattr(self, key, max(value, getattr(self, key)) if key in ('depth', 'seldepth') else value)
+		if info.score is not None:
+			best = self.lines.get(info.multipv)
+			if info.multipv == 1 and not info.bound and info.pv:
+				if best and best.pv and best.pv[0] == info.pv[0]:
+					if info.depth != best.depth:
+						self.stable += 1
+				else:
+					self.stable = 1
+			# Keep the last exact score, bounded ones only until an exact one arrives
+			if best is None or not info.bound or best.bound:
+				self.lines[info.multipv] = info
+
+	def info(self):
+		return self.lines.get(1)
+
+	def eval(self):
+		return self.info().eval() if self.info() else None
+
+	def pv(self):
+		return self.info().pv if self.info() else []
+
+	def __iter__(self):
+		return iter((self.bestmove, self.eval()))
+
+
+class AnalysisCache:
+	# Finished searches keyed by variant, skill and resulting position, least recently used dropped first.
+	# With a file name, entries are appended to it as json lines and reloaded on start.
+	def __init__(self, max_entries=100000, file_name=None):
+		self.entries = OrderedDict()
+		self.max_entries = max_entries
+		self.file_name = file_name
+		self.hits = 0
+		self.misses = 0
+		if file_name and os.path.isfile(file_name):
+			self.load()
+
+	@staticmethod
+	def key(variant, skill, fen, moves):
+		position = sf.get_fen(variant, fen, moves, True)
+		# The fullmove number doesn't change the search, the halfmove clock does
+		return f"{variant}|{skill}|{position.rsplit(' ', 1)[0]}"
+
+	@staticmethod
+	def covers(entry, limit):
+		# A search at least as long and deep as the one requested is good enough
+		budget = limit.budget()
+		return ((budget is None or entry['movetime'] >= budget)
+				and (limit.depth is None or entry['depth'] >= limit.depth)
+				and (limit.nodes is None or entry.get('nodes', 0) >= limit.nodes))
+
+	def get(self, key, limit):
+		entry = self.entries.get(key)
+		if entry is None or not self.covers(entry, limit):
+			self.misses += 1
+			metrics.ANALYSIS_CACHE_LOOKUPS.inc(result='miss')
+			return None
+
+		self.hits += 1
+		metrics.ANALYSIS_CACHE_LOOKUPS.inc(result='hit')
+		self.entries.move_to_end(key)
+		analysis = Analysis()
+		info = Info()
+		info.depth = entry['depth']
+		info.nodes = entry.get('nodes')
+		info.score = tuple(entry['score']) if entry['score'] else None
+		info.pv = entry['pv']
+		analysis.update(info)
+		analysis.bestmove = entry['bestmove']
+		analysis.ponder = entry['ponder']
+		analysis.cached = True
+		return analysis
+
+	def put(self, key, limit, analysis):
+		# Record the time the search reached, not what was asked for, so a search cut short
+		# by its hang deadline doesn't stand in for a full one. A search the stop policy ended
+		# counts as the whole budget, since the policy judged its result final.
+		info = analysis.info()
+		movetime = analysis.time
+		if analysis.stopped:
+			movetime = max(movetime, limit.budget() or 0)
+		entry = {'movetime': movetime,
+				 'bestmove': analysis.bestmove,
+				 'ponder': analysis.ponder,
+				 'score': info.score if info else None,
+				 'depth': analysis.depth,
+				 'nodes': analysis.nodes,
+				 'pv': analysis.pv()}
+		old = self.entries.get(key)
+		if old and old['movetime'] >= entry['movetime'] and old['depth'] >= entry['depth']:
+			return
+		self.add(key, entry)
+		if self.file_name:
+			with open(self.file_name, 'a') as f:
+				f.write(json.dumps([key, entry]) + '\n')
+
+	def add(self, key, entry):
+		self.entries[key] = entry
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.max_entries:
+			self.entries.popitem(last=False)
+
+	def load(self):
+		lines = 0
+		with open(self.file_name) as f:
+			for line in f:
+				try:
+					key, entry = json.loads(line)
+				except ValueError:
+					continue # partly written line
+				self.add(key, entry)
+				lines += 1
+
+		# Rewrite the file once superseded and evicted entries dominate it
+		if lines > 2 * len(self.entries):
+			with open(self.file_name, 'w') as f:
+				for key, entry in self.entries.items():
+					f.write(json.dumps([key, entry]) + '\n')
+
+	def stats(self):
+		lookups = self.hits + self.misses
+		return {'hits': self.hits,
+				'misses': self.misses,
+				'hit_rate': round(self.hits / lookups, 3) if lookups else 0,
+				'entries': len(self.entries)}
+
 class Engine:
 	def __init__(self, location, variants_file, variant, skill=20):
-		self.engine = subprocess.Popen(
-			location,
-			universal_newlines=True,
-			stdin=subprocess.PIPE,
-			stdout=subprocess.PIPE,
-			bufsize=1)
-		self.put(f"load {variants_file}")
-		self.put(f"setoption name UCI_Variant value {variant}")
-		self.put(f"setoption name Skill Level value {skill}")
+		self.location = location
+		self.variants_file = variants_file
+		self.variant = variant
+		self.skill = skill
+		self.threads = None
+		self.memory = None
+		self.game = None # game whose positions are in the hash table
+		self.busy = False # a command is waiting for output
+		self.pondering = None # (fen, moves) searched with go ponder
+		self.ponder_started = None # loop time of the last go ponder
+		self.grant = None # threads and hash reserved from the scheduler
+		self.engine = None
+		self.killed = False # the process may not be reaped yet, so returncode can still be None
+		self.started = None # until the first readyok, for the load time metric
+
+	async def start(self):
+		started = asyncio.get_running_loop().time()
+		self.engine = await asyncio.create_subprocess_exec(
+			self.location,
+			stdin=asyncio.subprocess.PIPE,
+			stdout=asyncio.subprocess.PIPE)
+		self.started = asyncio.get_running_loop().time()
+		metrics.ENGINE_SPAWN_SECONDS.observe(self.started - started)
+		self.put(f"load {self.variants_file}")
+		self.put(f"setoption name UCI_Variant value {self.variant}")
+		self.put(f"setoption name Skill Level value {self.skill}")
 		self.put("setoption name UCI_Chess960 value true")
 
 		# Load NNUE
-		nnue = f"nnues\\{variant}.nnue"
+		nnue = f"nnues\\{self.variant}.nnue"
 		if os.path.isfile(nnue):
 			self.put(f"setoption name EvalFile value {nnue}")
+		return self
 
 	def put(self, command):
-		self.engine.stdin.write(command + "\n")
+		if not self.alive():
+			raise EngineError(f"{self.variant} engine is not running")
+		self.engine.stdin.write((command + "\n").encode())
+
+	async def readline(self, timeout=None):
+		try:
+			text = await asyncio.wait_for(self.engine.stdout.readline(), timeout)
+		except asyncio.TimeoutError:
+			raise EngineError(f"{self.variant} engine did not answer within {timeout:.1f}s")
+		if not text: # EOF, the process has died
+			raise EngineError(f"{self.variant} engine exited with code {self.engine.returncode}")
+		return text.decode().strip()
 
-	def get(self):
+	async def get(self, timeout=READY_TIMEOUT):
+		loop = asyncio.get_running_loop()
+		sent = loop.time()
+		self.busy = True
 		self.put("isready")
 		output = []
 		while True:
-			text = self.engine.stdout.readline().strip()
+			text = await self.readline(timeout)
 			if text == "readyok":
 				break
 			output += [text]
+		self.busy = False
+
+		metrics.ENGINE_READY_SECONDS.observe(loop.time() - sent)
+		if self.started is not None:
+			# First readyok, the variants file and NNUE are loaded
+			metrics.ENGINE_LOAD_SECONDS.observe(loop.time() - self.started, variant=self.variant)
+			self.started = None
 		return output
 
+	def alive(self):
+		return self.engine is not None and not self.killed and self.engine.returncode is None
+
+	async def ping(self):
+		if not self.alive():
+			return False
+		try:
+			await self.get(5)
+		except EngineError:
+			return False
+		return True
+
 	async def allocate(self, threads=None, memory=None):
-		if threads:
+		# Only resend changed options, resizing the hash clears it
+		if threads and threads != self.threads:
 			self.put(f"setoption name threads value {threads}")
-		if memory: # MB
+			self.threads = threads
+		if memory and memory != self.memory: # MB
 			self.put(f"setoption name hash value {memory}")
-		self.get() # check that engine is ready
+			self.memory = memory
+		await self.get() # check that engine is ready
 		return
 
-	async def analyze(self, fen, moves, movetime):
+	async def new_game(self, game=None):
+		if game is None or game != self.game:
+			self.put("ucinewgame")
+		self.game = game
+
+	async def ponder(self, fen, moves, limit):
+		# Search the expected position while the opponent thinks, analyze() picks it up
+		if not isinstance(limit, Limit):
+			limit = Limit(movetime=limit)
+		self.busy = True
 		self.put(f"position fen {fen} moves {' '.join(moves)}")
-		self.put(f"go movetime {movetime}")
+		self.put(f"go ponder {limit.go()}")
+		self.pondering = (fen, list(moves))
+		self.ponder_started = asyncio.get_running_loop().time()
 
-		# Get engine output
-		std_output = []
-		while True:
-			if std_output:
-				bestmove_found = findall('bestmove .+', std_output[-1])
-				if bestmove_found:
-					bestmove = bestmove_found[0].split()[1]
-					engine_eval = findall("(?:cp|mate) [-]?\d+", ''.join(std_output))[-1]
+	async def analyze(self, fen, moves, limit, on_info=None, policy=None):
+		# limit is a Limit or a movetime in ms.
+		# on_info is called (or awaited) with each Info and the Analysis so far,
+		# policy is a StopPolicy deciding whether to stop before the limit.
+		if not isinstance(limit, Limit):
+			limit = Limit(movetime=limit)
+		legal_moves = len(sf.legal_moves(self.variant, fen, moves, True)) if policy else None
+		white = (limit.wtime is None and limit.btime is None) or sf.get_fen(self.variant, fen, moves, True).split()[1] == 'w'
+		budget = limit.budget(white)
+
+		ponderhit = self.pondering == (fen, list(moves))
+		if ponderhit:
+			# Expected move was played, time counts from the start of pondering
+			self.pondering = None
+			self.put("ponderhit")
+		else:
+			await self.stop()
+			self.busy = True
+			self.put(f"position fen {fen} moves {' '.join(moves)}")
+			self.put(f"go {limit.go()}")
+
+		# Parse engine output line by line as it arrives
+		analysis = Analysis()
+		loop = asyncio.get_running_loop()
+		started = loop.time()
+		deadline = started + (budget / 1000 if budget else MAX_SEARCH) + SEARCH_MARGIN
+		stopped = False
+		try:
+			while True:
+				try:
+					text = await self.readline(deadline - loop.time())
+				except EngineError:
+					if stopped or not self.alive():
+						raise
+					# Overran the movetime, ask for the best move found so far
+					self.put("stop")
+					stopped = True
+					deadline = loop.time() + 5
+					continue
+				if text.startswith("bestmove"):
+					tokens = text.split()
+					analysis.bestmove = tokens[1]
+					if len(tokens) > 3 and tokens[2] == "ponder":
+						analysis.ponder = tokens[3]
 					break
-			std_output += self.get()
-			await asyncio.sleep(0.01)
+				info = Info.parse(text)
+				if info is None:
+					continue
+				analysis.update(info)
+				if policy and not stopped:
+					analysis.stopped = policy.check(analysis, legal_moves, (loop.time() - started) * 1000, budget)
+					if analysis.stopped:
+						self.put("stop")
+						stopped = True
+				if on_info:
+					result = on_info(info, analysis)
+					if asyncio.iscoroutine(result):
+						await result
+		except asyncio.CancelledError:
+			await self.stop()
+			raise
+		self.busy = False
+
+		metrics.ENGINE_SEARCH_SECONDS.observe(loop.time() - started, variant=self.variant)
+		metrics.ENGINE_SEARCH_DEPTH.observe(analysis.depth, variant=self.variant)
+		metrics.ENGINE_SEARCH_NODES.observe(analysis.nodes, variant=self.variant)
+		metrics.ENGINE_SEARCH_NPS.observe(analysis.nps, threads=self.threads)
+		finish = 'ponderhit' if ponderhit else analysis.stopped or ('timeout' if stopped else 'limit')
+		metrics.ENGINE_SEARCHES.inc(finish=finish.replace(' ', '_'))
+		return analysis
 
-		return (bestmove, engine_eval)
+	async def stop(self):
+		# Interrupt a search and discard its output so the engine can be reused
+		if not (self.busy or self.pondering):
+			return
+		self.pondering = None
+		try:
+			self.put("stop")
+			while not (await self.readline(5)).startswith("bestmove"):
+				pass
+			self.busy = False
+		except EngineError:
+			self.kill()
+		except asyncio.CancelledError:
+			# Output is left half read, so the engine can't be reused, but the caller still gets cancelled
+			self.kill()
+			raise
+
+	def kill(self):
+		if self.alive():
+			self.killed = True
+			try:
+				self.engine.kill()
+			except ProcessLookupError:
+				pass
 
 	async def quit(self):
-		self.put("quit")
\ No newline at end of file
+		try:
+			self.put("quit")
+			await asyncio.wait_for(self.engine.wait(), 5)
+		except (EngineError, asyncio.TimeoutError):
+			self.kill()
+
+
+PRIORITY_MOVE = 0 # bot moves, served first
+PRIORITY_EVAL = 1
+PRIORITY_REVIEW = 2 # post-game reviews
+
+class Grant:
+	def __init__(self, threads, memory, owner):
+		self.threads = threads
+		self.memory = memory
+		self.owner = owner
+
+
+class Scheduler:
+	# Hands out threads and hash from a fixed budget, queueing searches that don't fit.
+	# Waiting searches are served by priority, and round robin across owners (guilds) within a priority.
+	def __init__(self, cores, memory):
+		self.cores = cores
+		self.memory = memory # MB
+		self.used_cores = 0
+		self.used_memory = 0
+		self.idle_memory = 0 # MB still held by idle engines after their grants were released
+		self.queues = {} # priority: {owner: [(future, threads, memory, queued at)]}
+		self.preempt = None # called when searches are waiting, to free pondering engines
+		self.reclaim = None # called when idle engines' hash keeps a search waiting, to quit one
+		self.granted = 0
+		self.wait_total = 0
+		self.wait_max = 0
+
+	def fits(self, threads, memory):
+		return self.used_cores + threads <= self.cores and self.used_memory + self.idle_memory + memory <= self.memory
+
+	async def acquire(self, threads, memory, priority=PRIORITY_MOVE, owner=None):
+		threads = min(threads or 1, self.cores)
+		memory = min(memory or 16, self.memory)
+		loop = asyncio.get_running_loop()
+		future = loop.create_future()
+		queue = self.queues.setdefault(priority, {}).setdefault(owner, [])
+		queue.append((future, threads, memory, loop.time()))
+		self.dispatch()
+		try:
+			return await future
+		except asyncio.CancelledError:
+			if future.done() and not future.cancelled():
+				self.release(future.result()) # granted just as it was cancelled
+			else:
+				self.remove(future)
+			raise
+
+	def remove(self, future):
+		for owners in self.queues.values():
+			for owner, queue in list(owners.items()):
+				queue[:] = [request for request in queue if request[0] is not future]
+				if not queue:
+					del owners[owner]
+		self.dispatch()
+
+	def release(self, grant):
+		self.used_cores -= grant.threads
+		self.used_memory -= grant.memory
+		self.dispatch()
+
+	def hold_idle(self, memory):
+		# An engine went idle keeping memory MB of hash, negative when it leaves the idle list
+		self.idle_memory += memory
+		if memory < 0:
+			self.dispatch()
+
+	def dispatch(self):
+		self.serve()
+		metrics.SCHEDULER_QUEUED.set(self.queued())
+
+	def serve(self):
+		loop = asyncio.get_running_loop()
+		for priority in sorted(self.queues):
+			owners = self.queues[priority]
+			while owners:
+				owner, queue = next(iter(owners.items()))
+				future, threads, memory, queued = queue[0]
+				if future.cancelled():
+					queue.pop(0)
+				elif self.fits(threads, memory):
+					queue.pop(0)
+					self.used_cores += threads
+					self.used_memory += memory
+					waited = loop.time() - queued
+					self.granted += 1
+					self.wait_total += waited
+					self.wait_max = max(self.wait_max, waited)
+					metrics.SCHEDULER_WAIT_SECONDS.observe(waited, priority=priority)
+					future.set_result(Grant(threads, memory, owner))
+				else:
+					# Head of the line doesn't fit, lower priorities wait behind it
+					if self.reclaim and self.idle_memory and self.used_memory + self.idle_memory + memory > self.memory:
+						self.reclaim()
+					elif self.preempt:
+						# Pondering is speculative, so it gives way to any waiting search
+						self.preempt()
+					return
+				# Rotate owners so one guild can't monopolise the engines
+				del owners[owner]
+				if queue:
+					owners[owner] = queue
+
+	def queued(self):
+		return sum(len(queue) for owners in self.queues.values() for queue in owners.values())
+
+	def stats(self):
+		return {'queued': self.queued(),
+				'cores_used': f"{self.used_cores}/{self.cores}",
+				'hash_used': f"{self.used_memory}/{self.memory}",
+				'hash_idle': self.idle_memory,
+				'granted': self.granted,
+				'wait_avg': round(self.wait_total / self.granted, 2) if self.granted else 0,
+				'wait_max': round(self.wait_max, 2)}
+
+
+class EnginePool:
+	# Long-lived engines keyed by variant and skill, reused between searches
+	def __init__(self, location, variants_file, max_idle=4, cache=None, max_ponder=2, scheduler=None):
+		self.location = location
+		self.variants_file = variants_file
+		self.max_idle = max_idle
+		self.cache = cache
+		self.max_ponder = max_ponder
+		self.scheduler = scheduler
+		if scheduler:
+			scheduler.preempt = self.preempt
+			scheduler.reclaim = self.reclaim
+		self.pondering = {} # game: engine pondering on it, oldest first
+		self.idle = [] # least recently used first
+		self.spawned = 0
+		self.restarted = 0
+
+	def take(self, variant, skill, game):
+		matches = [engine for engine in self.idle if (engine.variant, engine.skill) == (variant, skill)]
+		if not matches:
+			return None
+		# Prefer the engine that searched this game last, its hash is still useful
+		warm = [engine for engine in matches if game is not None and engine.game == game]
+		engine = (warm or matches)[-1]
+		self.unpark(engine)
+		return engine
+
+	def park(self, engine):
+		# Idle engines keep their hash, so it stays counted against the scheduler's budget
+		self.idle.append(engine)
+		if self.scheduler:
+			self.scheduler.hold_idle(engine.memory or 0)
+
+	def unpark(self, engine):
+		self.idle.remove(engine)
+		if self.scheduler:
+			self.scheduler.hold_idle(-(engine.memory or 0))
+
+	async def acquire(self, variant, skill=20, threads=None, memory=None, game=None, take_ponder=True):
+		# take_ponder hands over the engine pondering on this game, only bot moves should
+		engine = self.pondering.pop(game, None) if game is not None and take_ponder else None
+		if engine:
+			if engine.alive() and (engine.variant, engine.skill) == (variant, skill):
+				# Hand back the pondering engine as is, analyze() decides on ponderhit
+				return engine
+			await engine.stop()
+			await self.release(engine)
+
+		while True:
+			engine = self.take(variant, skill, game)
+			if engine is None:
+				engine = await Engine(self.location, self.variants_file, variant, skill).start()
+				self.spawned += 1
+				metrics.ENGINE_SPAWNS.inc(variant=variant)
+				break
+			if await engine.ping():
+				break
+			engine.kill() # crashed while idle, try the next one or respawn
+			self.restarted += 1
+			metrics.ENGINE_RESTARTS.inc()
+		try:
+			await engine.allocate(threads, memory)
+			await engine.new_game(game)
+		except EngineError:
+			engine.kill()
+			raise
+		return engine
+
+	async def release(self, engine):
+		if engine.busy:
+			# Output may be left half read, don't hand this engine out again
+			engine.kill()
+		if engine.alive():
+			# Parked before the grant goes back, so its hash is never free for a moment
+			self.park(engine)
+		if engine.grant:
+			self.scheduler.release(engine.grant)
+			engine.grant = None
+		while len(self.idle) > self.max_idle:
+			engine = self.idle[0]
+			self.unpark(engine)
+			await engine.quit()
+
+	@asynccontextmanager
+	async def engine(self, variant, skill=20, threads=None, memory=None, game=None):
+		engine = await self.acquire(variant, skill, threads, memory, game)
+		try:
+			yield engine
+		finally:
+			await self.release(engine)
+
+	async def analyze(self, variant, skill, threads, memory, fen, moves, limit, game=None, on_info=None, ponder=False,
+					  priority=PRIORITY_MOVE, owner=None, policy=None, max_wait=None):
+		# max_wait is how many seconds to wait for the scheduler, asyncio.TimeoutError after that
+		if not isinstance(limit, Limit):
+			limit = Limit(movetime=limit)
+		if self.cache:
+			key = self.cache.key(variant, skill, fen, moves)
+			analysis = self.cache.get(key, limit)
+			if analysis:
+				if priority == PRIORITY_MOVE:
+					await self.stop_pondering(game)
+				return analysis
+
+		try:
+			analysis = await self.search(variant, skill, threads, memory, fen, moves, limit, game, on_info, ponder, priority, owner, policy, max_wait)
+		except EngineError:
+			# One retry on a fresh process if the engine died mid-search
+			self.restarted += 1
+			metrics.ENGINE_RESTARTS.inc()
+			analysis = await self.search(variant, skill, threads, memory, fen, moves, limit, game, on_info, ponder, priority, owner, policy, max_wait)
+
+		if self.cache and analysis.bestmove:
+			self.cache.put(key, limit, analysis)
+		return analysis
+
+	async def search(self, variant, skill, threads, memory, fen, moves, limit, game, on_info, ponder, priority, owner, policy, max_wait=None):
+		grant = None
+		# Evals and reviews of a game leave the bot's ponder running on its own engine
+		take_ponder = priority == PRIORITY_MOVE
+		engine = self.pondering.get(game) if game is not None and take_ponder else None
+		if self.scheduler and not (engine and engine.alive() and (engine.variant, engine.skill) == (variant, skill)):
+			# A live pondering engine for this game keeps the threads and hash it was granted,
+			# a dead one is replaced by acquire() and the new engine needs a grant of its own
+			grant = await asyncio.wait_for(self.scheduler.acquire(threads, memory, priority, owner), max_wait)
+			threads, memory = grant.threads, grant.memory
+		try:
+			engine = await self.acquire(variant, skill, threads, memory, game, take_ponder)
+		except BaseException:
+			if grant:
+				self.scheduler.release(grant)
+			raise
+		if grant:
+			if engine.grant:
+				self.scheduler.release(engine.grant)
+			engine.grant = grant
+		try:
+			analysis = await engine.analyze(fen, moves, limit, on_info, policy)
+			if ponder and game is not None and analysis.ponder:
+				# Keep this engine for the game, thinking on the expected reply
+				await engine.ponder(fen, moves + [analysis.bestmove, analysis.ponder], limit)
+				self.pondering[game] = engine
+				# The engine ignores movetime while pondering, so it is stopped if the reply never comes
+				cap = PONDER_CAP * (limit.budget() or MAX_SEARCH * 1000) / 1000
+				asyncio.get_running_loop().call_later(cap, self.expire_ponder, game, engine, engine.ponder_started)
+				engine = None
+				while len(self.pondering) > self.max_ponder:
+					await self.stop_pondering(next(iter(self.pondering)))
+			return analysis
+		finally:
+			if engine:
+				await self.release(engine)
+
+	async def stop_pondering(self, game):
+		engine = self.pondering.pop(game, None) if game is not None else None
+		if engine:
+			await engine.stop()
+			await self.release(engine)
+
+	def expire_ponder(self, game, engine, started):
+		# Only if it is still the same ponder, the engine may have moved on and pondered again
+		if self.pondering.get(game) is engine and engine.ponder_started == started:
+			asyncio.ensure_future(self.stop_pondering(game))
+
+	def reclaim(self):
+		# Searches are waiting on hash held by idle engines, quit the least recently used one
+		if self.idle:
+			engine = self.idle[0]
+			self.unpark(engine)
+			asyncio.ensure_future(engine.quit())
+
+	def preempt(self):
+		# Searches are waiting for capacity, stop the oldest ponder to free its threads and hash
+		if self.pondering:
+			asyncio.ensure_future(self.stop_pondering(next(iter(self.pondering))))
+
+	def stats(self):
+		stats = {'idle': len(self.idle), 'pondering': len(self.pondering), 'spawned': self.spawned, 'restarted': self.restarted}
+		if self.cache:
+			stats.update({f"cache_{key}": value for key, value in self.cache.stats().items()})
+		if self.scheduler:
+			stats.update({f"scheduler_{key}": value for key, value in self.scheduler.stats().items()})
+		return stats
+
+	async def close(self):
+		for game in list(self.pondering):
+			await self.stop_pondering(game)
+		while self.idle:
+			engine = self.idle[-1]
+			self.unpark(engine)
+			await engine.quit()
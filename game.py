@@ -1,8 +1,9 @@
-from variant import Variant
-from clip import GameClip
-from board import DrawBoard
+from variant import Variant, load_registry
+from clip import GameClip, AnimatedClip
+from board import DrawBoard, SQ_SIZE, preload_sprites
+from compositor import ArrayBoard
 from time import time
-from re import findall
+from array import array
 
 import pyffish as sf
 
@@ -32,13 +33,77 @@ VARIANTS = {
 			'twokings':			Variant()
 			}
 
+SAVE_VERSION = 1 # of Game.to_dict()
+SAVED = ('variant', 'wplayer', 'bplayer', 'start', 'drawcount', 'w_offered_draw', 'b_offered_draw', 'w_offered_takeback',
+		 'b_offered_takeback', 'bot_skill', 'premove', 'fen', 'active') # saved as they are, besides the moves and startpos
+
+def position_key(fen):
+	# FEN without the halfmove clock and fullmove number, equal for repeated positions
+	return fen.rsplit(' ', 2)[0]
+
+
+class MoveTable:
+	# Legal moves of one position in UCI and SAN, with the lookups closest_san needs
+	def __init__(self, variant, fen):
+		self.fen = fen
+		self.uci = sf.legal_moves(variant, fen, [], True)
+		self.san = [sf.get_san(variant, fen, move, True) for move in self.uci]
+		self.san_to_uci = dict(zip(self.san, self.uci))
+		self.uci_to_san = dict(zip(self.uci, self.san))
+
+		# SAN strings by exact text, prefix, lowercase text and lowercase prefix
+		self.exact = {}
+		self.prefix = {}
+		self.lower = {}
+		self.lower_prefix = {}
+		for san in self.san:
+			self.exact.setdefault(san, []).append(san)
+			self.lower.setdefault(san.lower(), []).append(san)
+			for i in range(1, len(san) + 1):
+				self.prefix.setdefault(san[:i], []).append(san)
+				self.lower_prefix.setdefault(san[:i].lower(), []).append(san)
+
+	def closest(self, input_move):
+		for index, key in ((self.exact, input_move), (self.prefix, input_move),
+						   (self.lower, input_move.lower()), (self.lower_prefix, input_move.lower())):
+			matches = index.get(key, [])
+			if len(matches) == 1:
+				return matches[0]
+
+		return None
+
+
+class MoveCodec:
+	# Numbers a variant's UCI moves in the order they are first played, so games can store them as 2-byte codes
+	def __init__(self):
+		self.codes = {}
+		self.moves = []
+
+	def encode(self, move):
+		code = self.codes.get(move)
+		if code is None:
+			code = self.codes[move] = len(self.moves)
+			self.moves += [move]
+		return code
+
+
+CODECS = {} # variant: MoveCodec, shared by every game
+
+def codec(variant):
+	return CODECS.setdefault(variant, MoveCodec())
+
+
 class Game:
+	__slots__ = ('variant', 'wplayer', 'bplayer', 'start', 'codes', 'drawcount', 'w_offered_draw', 'b_offered_draw',
+				 'w_offered_takeback', 'b_offered_takeback', 'bot_skill', 'premove', 'custom_fen', 'startpos', 'fen',
+				 'active', 'table', 'fens', 'sans', 'end_check')
+
 	def __init__(self, variant='chess', wplayer=None, bplayer=None, startpos=None):
 		self.variant = variant
 		self.wplayer = wplayer
 		self.bplayer = bplayer
 		self.start = time()
-		self.moves = []
+		self.codes = array('H') # moves as MoveCodec codes, widened to 'I' if a variant ever needs more than 65536
 		self.drawcount = 0
 		self.w_offered_draw = False
 		self.b_offered_draw = False
@@ -46,25 +111,106 @@ class Game:
 		self.b_offered_takeback = False
 		self.bot_skill = 0
 		self.premove = None
-		self.custom_fen = startpos and (startpos != sf.start_fen(variant))
-		self.startpos = startpos if self.custom_fen else sf.start_fen(variant)
+		self.custom_fen = startpos and (startpos != Game.start_fen(variant))
+		self.startpos = startpos if self.custom_fen else Game.start_fen(variant)
 		self.fen = self.startpos
 		self.active = True
+		self.table = None # MoveTable of the current position
+		self.fens = [self.fen] # FEN after every ply, the start position first
+		self.sans = [] # SAN of every move
+		self.end_check = None # (ply, fen, ended() result)
+
+	@property
+	def moves(self):
+		# UCI moves, decoded from the packed codes
+		moves = codec(self.variant).moves
+		return [moves[code] for code in self.codes]
+
+	@moves.setter
+	def moves(self, moves):
+		self.codes = array('H')
+		for move in moves:
+			self.add_code(move)
+
+	def add_code(self, move):
+		code = codec(self.variant).encode(move)
+		if code > 0xFFFF and self.codes.typecode == 'H':
+			self.codes = array('I', self.codes)
+		self.codes.append(code)
+
+	def to_dict(self):
+		# Versioned save of the game, with the moves as one UCI string and without the history or caches
+		data = {name: getattr(self, name) for name in SAVED}
+		data['version'] = SAVE_VERSION
+		data['moves'] = ' '.join(self.moves)
+		data['startpos'] = self.startpos if self.custom_fen else None
+		return data
+
+	@staticmethod
+	def from_dict(data):
+		# Saves without a version are the __dict__ of the old Game, with the moves as a list
+		if data.get('version', 0) > SAVE_VERSION:
+			raise ValueError(f"game saved by a newer version ({data['version']})")
+		game = Game(data['variant'], data['wplayer'], data['bplayer'], data.get('startpos'))
+		for name in SAVED:
+			if name in data:
+				setattr(game, name, data[name])
+		moves = data.get('moves', '')
+		game.moves = moves.split() if isinstance(moves, str) else moves
+		return game
+
+	def history(self):
+		# FENs and SANs per ply, appended to as moves are made
+		if len(self.fens) != len(self.codes) + 1: # loaded from a save, or moves set directly
+			self.fens = [self.startpos]
+			self.sans = []
+			for move in self.moves:
+				self.sans += [sf.get_san(self.variant, self.fens[-1], move, True)]
+				self.fens += [sf.get_fen(self.variant, self.fens[-1], [move], True)]
+		return self.fens, self.sans
+
+	def fen_at(self, ply):
+		# Position after the first ply moves
+		return self.history()[0][ply]
+
+	def move_at(self, ply):
+		# UCI move that led to fen_at(ply)
+		return codec(self.variant).moves[self.codes[ply - 1]] if ply else None
+
+	def move_table(self):
+		if self.table is None or self.table.fen != self.fen:
+			self.table = MoveTable(self.variant, self.fen)
+		return self.table
 
 	@staticmethod
 	def variants_list():
 		return sorted(VARIANTS.keys())
 
 	@staticmethod
-	def set_rules(ini_text):
-		for definition in ini_text.split('\n\n'):
-			variant_name = findall("\[(.+?)[:|\]]", definition)[0]
-			VARIANTS[variant_name].rules = definition
+	def load_variants(ini_text, snapshot_file=None):
+		# Rules, start positions and board geometry, once the ini is loaded into pyffish
+		load_registry(VARIANTS, ini_text, snapshot_file)
 
 	@staticmethod
 	def rules(variant):
 		return VARIANTS[variant].rules
 
+	@staticmethod
+	def start_fen(variant):
+		return VARIANTS[variant].start_fen or sf.start_fen(variant)
+
+	@staticmethod
+	def load_graphics(variant):
+		# Sprites are decoded the first time a variant is drawn, in whichever process draws it.
+		# Only pieces from the start position are preloaded, anything else is loaded when drawn.
+		settings = VARIANTS[variant]
+		if not settings.graphics_loaded:
+			if settings.start_fen is None:
+				settings.describe(variant) # worker processes don't load the registry
+			preload_sprites(settings.folder, settings.flip_pieces, settings.pieces)
+			settings.graphics_loaded = True
+		return settings
+
 	def age_minutes(self):
 		return round((time()-self.start)/60, 2)
 
@@ -72,108 +218,115 @@ class Game:
 		white_to_move = "w" in self.fen.split()
 		return ["Black", "White"][white_to_move != opposite] # if opposite is True, white_to_move is flipped
 
-	def render(self, img_name):
-		upside_down = self.turn() == "Black"
-		flip_pieces = VARIANTS[self.variant].flip_pieces and upside_down
-		lastmove = self.moves[-1] if self.moves else None
-		folder = VARIANTS[self.variant].folder
-		board_type = VARIANTS[self.variant].board_type
-		intersections = VARIANTS[self.variant].intersections
-		invert_text = VARIANTS[self.variant].invert_text
+	def last_move(self):
+		return self.move_at(len(self.codes))
 
-		DrawBoard(board_type, folder, flip_pieces, upside_down, intersections, invert_text,
-				self.fen, lastmove).render_board(img_name)
+	def render(self, img_name=None, sq_size=SQ_SIZE):
+		return Game.render_position(self.variant, self.fen, self.last_move(), self.turn() == "Black", img_name, sq_size)
 
-		return img_name
+	def render_clip(self, clip_name=None, codec='mp4'):
+		return Game.render_moves(self.variant, self.startpos, self.moves, self.fen, clip_name, codec, self.history()[0])
 
-	def render_clip(self, clip_name):
+	# The static renderers only take picklable arguments, so they can also run in a worker process.
+	# Without a file name they return the encoded image or clip as bytes.
+
+	@staticmethod
+	def render_position(variant, fen, lastmove, upside_down, img_name=None, sq_size=SQ_SIZE):
+		settings = Game.load_graphics(variant)
+		flip_pieces = settings.flip_pieces and upside_down
+		folder = settings.folder
+		board_type = settings.board_type
+		intersections = settings.intersections
+		invert_text = settings.invert_text
+
+		img = DrawBoard(board_type, folder, flip_pieces, upside_down, intersections, invert_text,
+						fen, lastmove, sq_size).render_board(img_name)
+
+		return img_name or img
+
+	@staticmethod
+	def render_moves(variant, startpos, moves, fen, clip_name=None, codec='mp4', fens=None):
 		WIDTH = 800
 		HEIGHT = 1000
 		FPS = 2
 
-		clip = GameClip(WIDTH, HEIGHT, FPS, clip_name)
+		# codec is 'mp4' for a video, or 'gif', 'webp' or 'apng' for an animated image
+		# fens, the game's FEN after every ply, saves replaying the moves
+		if codec == 'mp4':
+			clip = GameClip(WIDTH, HEIGHT, FPS, clip_name)
+		else:
+			clip = AnimatedClip(WIDTH, HEIGHT, FPS, clip_name, codec)
+		# frames are composited as BGR arrays and written to the clip without any conversion
 		# upside_down and flip_pieces will be false as the board is always from White's view
 		flip_pieces = upside_down = lastmove = False
-		board_type = VARIANTS[self.variant].board_type
-		folder = VARIANTS[self.variant].folder
-		intersections = VARIANTS[self.variant].intersections
-		invert_text = VARIANTS[self.variant].invert_text
+		settings = Game.load_graphics(variant)
+		board_type = settings.board_type
+		folder = settings.folder
+		intersections = settings.intersections
+		invert_text = settings.invert_text
 
 		# add end position
-		if len(self.moves) > 0:
-			board_img = DrawBoard(board_type, folder, flip_pieces, upside_down, intersections, invert_text,
-								self.fen, self.moves[-1]).draw_board(stabilise_pocket=True)
-
-			frame = DrawBoard.scale_to_fit(WIDTH, HEIGHT, board_img)
-			clip.add_img(frame, frames=2)
+		# every frame is drawn directly at the clip's resolution, so nothing needs to be resampled
+		previous = None
+		if len(moves) > 0:
+			previous = ArrayBoard(board_type, folder, flip_pieces, upside_down, intersections, invert_text,
+								  fen, moves[-1])
+			frame = previous.draw_frame(WIDTH, HEIGHT)
+			clip.add_frame(frame, frames=2)
 
 		# add start position
-		curr_fen = self.startpos
-		board_img = DrawBoard(board_type, folder, flip_pieces, upside_down, intersections, invert_text,
-							  curr_fen, lastmove).draw_board(stabilise_pocket=True)
-
-		frame = DrawBoard.scale_to_fit(WIDTH, HEIGHT, board_img)
-		clip.add_img(frame, frames=1)
-
-		# loop over each move and repeat
-		for i in range(len(self.moves)):
-			lastmove = self.moves[i]
-			curr_fen = sf.get_fen(self.variant, curr_fen, [lastmove], True)
-
-			board_img = DrawBoard(board_type, folder, flip_pieces, upside_down, intersections, invert_text,
-								  curr_fen, lastmove).draw_board(stabilise_pocket=True)
-
-			frame = DrawBoard.scale_to_fit(WIDTH, HEIGHT, board_img)
-
-			clip.add_img(frame, frames=1)
+		curr_fen = startpos
+		drawing = ArrayBoard(board_type, folder, flip_pieces, upside_down, intersections, invert_text,
+							 curr_fen, lastmove)
+		frame = drawing.draw_frame(WIDTH, HEIGHT, previous)
+		clip.add_frame(frame, frames=1)
+
+		# loop over each move and repeat, repainting only what changed since the last frame
+		for i in range(len(moves)):
+			lastmove = moves[i]
+			curr_fen = fens[i + 1] if fens else sf.get_fen(variant, curr_fen, [lastmove], True)
+
+			previous = drawing
+			drawing = ArrayBoard(board_type, folder, flip_pieces, upside_down, intersections, invert_text,
+								 curr_fen, lastmove)
+			frame = drawing.draw_frame(WIDTH, HEIGHT, previous)
+			clip.add_frame(frame, frames=1)
 
 		# save the clip
-		clip.save()
-		return clip_name
+		return clip.save()
 
 	def closest_san(self, input_move):
-		legal = self.legal_moves() # All legal moves, in SAN format
-
-		match_casesens = [m for m in legal if m == input_move]
-		if len(match_casesens) == 1:
-			return match_casesens[0]
-
-		prefix_casesens = [m for m in legal if m.startswith(input_move)]
-		if len(prefix_casesens) == 1:
-			return prefix_casesens[0]
-
-		match_lower = [m for m in legal if m.lower() == input_move.lower()]
-		if len(match_lower) == 1:
-			return match_lower[0]
-
-		prefix_lower = [m for m in legal if m.lower().startswith(input_move.lower())]
-		if len(prefix_lower) == 1:
-			return prefix_lower[0]
-
-		return None
+		# exact match, then prefix, then the same case-insensitively
+		return self.move_table().closest(input_move)
 
 	def make_move(self, san_move):
-		uci_legal_moves = sf.legal_moves(self.variant, self.fen, [], True)
-
-		for move in uci_legal_moves:
-			if sf.get_san(self.variant, self.fen, move, True) == san_move:
-				self.moves += [move]
-				break
+		move = self.move_table().san_to_uci[san_move]
+		fens, sans = self.history()
+		self.add_code(move)
 
 		self.cancel_offers()
 		self.fen = sf.get_fen(self.variant, self.fen, [move], True)
+		self.table = None
+		fens += [self.fen]
+		sans += [san_move]
 
 	def legal_moves(self):
-		uci_moves = sf.legal_moves(self.variant, self.fen, [], True)
-		return [sf.get_san(self.variant, self.fen, move, True) for move in uci_moves]
+		return list(self.move_table().san) # All legal moves, in SAN format
+
+	def san(self, uci_move):
+		return self.move_table().uci_to_san[uci_move]
 
 	def get_moves(self):
-		return sf.get_san_moves(self.variant, self.startpos, self.moves, True)
+		return list(self.history()[1])
 
 	def takeback_move(self, count):
-		self.moves = self.moves[:-count]
+		fens, sans = self.history()
+		del self.codes[max(len(self.codes) - count, 0):]
+		del fens[len(self.codes) + 1:]
+		del sans[len(self.codes):]
 		self.cancel_offers()
-		self.fen = sf.get_fen(self.variant, self.startpos, self.moves, True)
+		self.fen = fens[-1]
+		self.table = None
 
 	def cancel_offers(self):
 		self.w_offered_draw = False
@@ -185,7 +338,7 @@ class Game:
 		return player_name in (self.wplayer, self.bplayer)
 
 	def drawn_game(self):
-		return self.drawcount >= 10 and len(self.moves) >= 80
+		return self.drawcount >= 10 and len(self.codes) >= 80
 
 	def is_selfplay(self):
 		return self.wplayer == self.bplayer
@@ -197,21 +350,32 @@ class Game:
 		return white_player or black_player
 
 	def ended(self):
-		uci_legal_moves = sf.legal_moves(self.variant, self.fen, [], True)
-
-		if (len(sf.legal_moves(self.variant, self.startpos, self.moves, True)) == 0
-			or sf.is_optional_game_end(self.variant, self.startpos, self.moves, True)[0]
-			or sf.is_immediate_game_end(self.variant, self.startpos, self.moves, True)[0]
-			or all(sf.has_insufficient_material(self.variant, self.startpos, self.moves, True))):
-
-			result = sf.game_result(self.variant, self.startpos, self.moves, True)
-			turn = self.turn()
+		ply = len(self.codes)
+		if self.end_check and self.end_check[:2] == (ply, self.fen):
+			return self.end_check[2]
+
+		# Only a repetition needs the game history, everything else can be judged from the FEN.
+		# Replaying from the position's first occurrence covers every repetition of it.
+		key = position_key(self.fen)
+		fens = self.history()[0]
+		first = next(i for i, fen in enumerate(fens) if position_key(fen) == key)
+		decode = codec(self.variant).moves
+		fen, moves = fens[first], [decode[code] for code in self.codes[first:]]
+
+		ended = False
+		if (len(self.move_table().uci) == 0
+			or sf.is_optional_game_end(self.variant, fen, moves, True)[0]
+			or sf.is_immediate_game_end(self.variant, fen, moves, True)[0]
+			or all(sf.has_insufficient_material(self.variant, fen, moves, True))):
+
+			result = sf.game_result(self.variant, fen, moves, True)
 
 			if result == sf.VALUE_MATE:
-				return self.turn()
+				ended = self.turn()
 			elif result == -sf.VALUE_MATE:
-				return self.turn(opposite=True)
+				ended = self.turn(opposite=True)
 			elif result == sf.VALUE_DRAW:
-				return 'Draw'
+				ended = 'Draw'
 
-		return False
\ No newline at end of file
+		self.end_check = (ply, self.fen, ended)
+		return ended
\ No newline at end of file
@@ -0,0 +1,149 @@
+# Counters, gauges and histograms for engine and bot latency, exported as Prometheus text or json lines.
+# Each metric can be split by labels: SEARCH_SECONDS.observe(1.2, variant='chess')
+import asyncio
+import json
+import time
+from bisect import bisect_left
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+DEPTH_BUCKETS = (1, 2, 4, 6, 8, 10, 12, 15, 20, 25, 30, 40, 60)
+NODE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9, 1e10)
+NPS_BUCKETS = (1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7, 2.5e7, 5e7, 1e8)
+
+METRICS = {} # name: metric, in registration order
+
+
+def label_key(labels):
+	return tuple(sorted(labels.items()))
+
+
+def label_text(key, extra=()):
+	pairs = list(key) + list(extra)
+	return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}' if pairs else ''
+
+
+class Counter:
+	kind = 'counter'
+
+	def __init__(self, name, help):
+		self.name = name
+		self.help = help
+		self.series = {}
+
+	def inc(self, amount=1, **labels):
+		key = label_key(labels)
+		self.series[key] = self.series.get(key, 0) + amount
+
+	def prometheus(self):
+		return [f"{self.name}{label_text(key)} {value}" for key, value in self.series.items()]
+
+	def snapshot(self):
+		return {label_text(key): value for key, value in self.series.items()}
+
+
+class Gauge(Counter):
+	kind = 'gauge'
+
+	def set(self, value, **labels):
+		self.series[label_key(labels)] = value
+
+
+class Histogram:
+	kind = 'histogram'
+
+	def __init__(self, name, help, buckets=TIME_BUCKETS):
+		self.name = name
+		self.help = help
+		self.buckets = buckets
+		self.series = {} # labels: [bucket counts (last is +Inf), sum, count]
+
+	def observe(self, value, **labels):
+		key = label_key(labels)
+		series = self.series.get(key)
+		if series is None:
+			series = self.series[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+		series[0][bisect_left(self.buckets, value)] += 1
+		series[1] += value
+		series[2] += 1
+
+	def quantile(self, series, q):
+		# Upper bound of the bucket holding the q-th observation
+		target = q * series[2]
+		seen = 0
+		for bound, count in zip(self.buckets + (float('inf'),), series[0]):
+			seen += count
+			if seen >= target:
+				return bound
+		return float('inf')
+
+	def prometheus(self):
+		lines = []
+		for key, series in self.series.items():
+			cumulative = 0
+			for bound, count in zip(self.buckets + ('+Inf',), series[0]):
+				cumulative += count
+				lines += [f"{self.name}_bucket{label_text(key, [('le', bound)])} {cumulative}"]
+			lines += [f"{self.name}_sum{label_text(key)} {series[1]}",
+					  f"{self.name}_count{label_text(key)} {series[2]}"]
+		return lines
+
+	def snapshot(self):
+		return {label_text(key): {'count': series[2],
+								  'mean': series[1] / series[2],
+								  'p50': self.quantile(series, 0.5),
+								  'p90': self.quantile(series, 0.9),
+								  'p99': self.quantile(series, 0.99)}
+				for key, series in self.series.items()}
+
+
+def register(metric):
+	return METRICS.setdefault(metric.name, metric)
+
+
+def counter(name, help):
+	return register(Counter(name, help))
+
+
+def gauge(name, help):
+	return register(Gauge(name, help))
+
+
+def histogram(name, help, buckets=TIME_BUCKETS):
+	return register(Histogram(name, help, buckets))
+
+
+def prometheus():
+	lines = []
+	for metric in METRICS.values():
+		if metric.series:
+			lines += [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} {metric.kind}"]
+			lines += metric.prometheus()
+	return '\n'.join(lines) + '\n'
+
+
+def snapshot():
+	return {name: metric.snapshot() for name, metric in METRICS.items() if metric.series}
+
+
+async def log_json(file_name, interval=60):
+	# Appends a snapshot of every metric as one json line per interval
+	while True:
+		await asyncio.sleep(interval)
+		with open(file_name, 'a') as f:
+			f.write(json.dumps({'time': round(time.time()), 'metrics': snapshot()}, default=str) + '\n')
+
+
+ENGINE_SPAWN_SECONDS = histogram('engine_spawn_seconds', 'Time to start an engine process')
+ENGINE_LOAD_SECONDS = histogram('engine_load_seconds', 'Time from process start until variants and NNUE are loaded')
+ENGINE_READY_SECONDS = histogram('engine_ready_seconds', 'Round trip of isready to readyok')
+ENGINE_SEARCH_SECONDS = histogram('engine_search_seconds', 'Time from go (or ponderhit) to bestmove')
+ENGINE_SEARCH_DEPTH = histogram('engine_search_depth', 'Depth reached by a search', DEPTH_BUCKETS)
+ENGINE_SEARCH_NODES = histogram('engine_search_nodes', 'Nodes searched', NODE_BUCKETS)
+ENGINE_SEARCH_NPS = histogram('engine_search_nps', 'Nodes per second at the end of a search', NPS_BUCKETS)
+ENGINE_SEARCHES = counter('engine_searches_total', 'Searches by how they finished')
+ENGINE_SPAWNS = counter('engine_spawns_total', 'Engine processes started')
+ENGINE_RESTARTS = counter('engine_restarts_total', 'Engines replaced after dying or hanging')
+ANALYSIS_CACHE_LOOKUPS = counter('analysis_cache_lookups_total', 'Analysis cache lookups by result')
+SCHEDULER_WAIT_SECONDS = histogram('scheduler_wait_seconds', 'Time a search waited for threads and hash')
+SCHEDULER_QUEUED = gauge('scheduler_queued', 'Searches waiting for threads and hash')
+BOT_MOVE_SECONDS = histogram('bot_move_seconds', 'Time for the bot to pick a move')
@@ -0,0 +1,95 @@
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+import asyncio
+
+import pyffish as sf
+
+from game import Game, VARIANTS
+from board import SQ_SIZE
+
+
+def init_worker(ini_text):
+	# forked workers already have the definitions, spawned ones load them here
+	# sprites are loaded by the first render of each variant
+	if not set(Game.variants_list()) <= set(sf.variants()):
+		sf.load_variant_config(ini_text)
+
+
+class ImageCache:
+	# least recently used images are dropped once the cache holds more than max_bytes
+	def __init__(self, max_bytes=64*1024*1024):
+		self.images = OrderedDict()
+		self.max_bytes = max_bytes
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def get(self, key):
+		img = self.images.get(key)
+		if img is None:
+			self.misses += 1
+			return None
+
+		self.hits += 1
+		self.images.move_to_end(key)
+		return img
+
+	def put(self, key, img):
+		if len(img) > self.max_bytes:
+			return
+
+		if key in self.images:
+			self.size -= len(self.images.pop(key))
+		self.images[key] = img
+		self.size += len(img)
+
+		while self.size > self.max_bytes:
+			_, old_img = self.images.popitem(last=False)
+			self.size -= len(old_img)
+			self.evictions += 1
+
+	def stats(self):
+		lookups = self.hits + self.misses
+		return {'hits': self.hits,
+				'misses': self.misses,
+				'hit_rate': round(self.hits / lookups, 3) if lookups else 0,
+				'evictions': self.evictions,
+				'images': len(self.images),
+				'bytes': self.size,
+				'max_bytes': self.max_bytes}
+
+
+class Renderer:
+	def __init__(self, ini_text, processes=None, cache_bytes=64*1024*1024):
+		# worker processes need the variant definitions loaded into their own copy of pyffish
+		self.pool = ProcessPoolExecutor(max_workers=processes, initializer=init_worker, initargs=(ini_text,))
+		self.cache = ImageCache(cache_bytes)
+
+	async def run(self, function, *args):
+		loop = asyncio.get_running_loop()
+		return await loop.run_in_executor(self.pool, function, *args)
+
+	async def render(self, game, sq_size=SQ_SIZE, ply=None):
+		# the current position, or the one after ply moves
+		if ply is None:
+			fen, lastmove = game.fen, game.last_move()
+		else:
+			fen, lastmove = game.fen_at(ply), game.move_at(ply)
+		upside_down = fen.split()[1] == 'b'
+		flip_pieces = VARIANTS[game.variant].flip_pieces and upside_down
+
+		# only the board and pocket part of the FEN affects the picture
+		key = (game.variant, fen.split()[0], lastmove, upside_down, flip_pieces, sq_size)
+		img = self.cache.get(key)
+		if img is None:
+			img = await self.run(Game.render_position, game.variant, fen, lastmove, upside_down, None, sq_size)
+			self.cache.put(key, img)
+		return img
+
+	async def render_clip(self, game, codec='mp4'):
+		return await self.run(Game.render_moves, game.variant, game.startpos, game.moves, game.fen, None, codec,
+							  list(game.history()[0]))
+
+	def shutdown(self):
+		self.pool.shutdown()
@@ -0,0 +1,141 @@
+# Post-game review: one engine evaluates every ply of a finished game under a time budget,
+# giving win chances, move accuracy and inaccuracy/mistake/blunder judgements per move.
+# Formulas follow lichess: win% from centipawns, accuracy from the drop in win%.
+import asyncio
+from math import exp
+
+import pyffish as sf
+
+from engine import Limit, PRIORITY_REVIEW
+
+MATE_CP = 10000 # centipawns a forced mate counts as
+JUDGEMENTS = ((15, 'blunder'), (10, 'mistake'), (5, 'inaccuracy')) # win% dropped by the mover
+SYMBOLS = {'blunder': '??', 'mistake': '?', 'inaccuracy': '?!'}
+PLURALS = {'blunder': 'blunders', 'mistake': 'mistakes', 'inaccuracy': 'inaccuracies'}
+
+
+def white_cp(score, white_to_move):
+	# Engine scores are from the side to move
+	kind, value = score
+	if kind == 'mate':
+		cp = MATE_CP if value > 0 else -MATE_CP
+	else:
+		cp = value
+	return cp if white_to_move else -cp
+
+
+def win_percent(cp):
+	return 50 + 50 * (2 / (1 + exp(-0.00368208 * cp)) - 1)
+
+
+def move_accuracy(win_before, win_after):
+	# Both from the mover's side
+	accuracy = 103.1668 * exp(-0.04354 * max(win_before - win_after, 0)) - 3.1669
+	return max(min(accuracy, 100), 0)
+
+
+def judgement(drop):
+	for threshold, name in JUDGEMENTS:
+		if drop >= threshold:
+			return name
+	return None
+
+
+class Review:
+	def __init__(self, variant, startpos, moves, wplayer=None, bplayer=None, sans=None):
+		self.variant = variant
+		self.startpos = startpos
+		self.moves = moves
+		self.wplayer = wplayer
+		self.bplayer = bplayer
+		self.sans = sans if sans is not None else sf.get_san_moves(variant, startpos, moves, True)
+		self.white_to_move = [] # per position, the last one after the final move
+		self.cps = [] # white centipawns per evaluated position
+		self.finished = False
+
+	def add(self, cp):
+		self.cps += [cp]
+
+	def plies(self):
+		# Moves with an eval before and after them
+		return max(len(self.cps) - 1, 0)
+
+	def move(self, ply):
+		white = self.white_to_move[ply]
+		sign = 1 if white else -1
+		win_before = win_percent(sign * self.cps[ply])
+		win_after = win_percent(sign * self.cps[ply + 1])
+		return {'ply': ply,
+				'white': white,
+				'uci': self.moves[ply],
+				'san': self.sans[ply],
+				'cp': self.cps[ply + 1],
+				'accuracy': move_accuracy(win_before, win_after),
+				'judgement': judgement(win_before - win_after)}
+
+	def summary(self):
+		moves = [self.move(ply) for ply in range(self.plies())]
+		lines = [f"**Game review** ({self.plies()}/{len(self.moves)} plies{'' if self.finished else ', analysing...'})"]
+		for white, name in ((True, self.wplayer or 'White'), (False, self.bplayer or 'Black')):
+			own = [move for move in moves if move['white'] == white]
+			if not own:
+				continue
+			accuracy = sum(move['accuracy'] for move in own) / len(own)
+			counts = [f"{sum(move['judgement'] == kind for move in own)} {PLURALS[kind]}" for _, kind in reversed(JUDGEMENTS)]
+			lines += [f"{name}: accuracy {accuracy:.0f}%, {', '.join(counts)}"]
+
+		errors = [move for move in moves if move['judgement'] in ('mistake', 'blunder')]
+		if errors:
+			notes = [f"{move['ply'] // 2 + 1}{'.' if move['white'] else '...'} {move['san']}{SYMBOLS[move['judgement']]} ({move['cp'] / 100:+.1f})"
+					 for move in errors]
+			lines += ["Mistakes and blunders: " + ', '.join(notes)]
+		return '\n'.join(lines)[:2000]
+
+
+async def review_game(pool, review, budget=60, max_movetime=2000, threads=1, memory=256, owner=None, on_progress=None):
+	# Positions are searched in order, preferring the engine that searched the last one so its hash carries over.
+	# Between positions the engine is parked in the pool, so its hash counts against the scheduler's budget.
+	# on_progress is called (or awaited) with the Review after every position.
+	loop = asyncio.get_running_loop()
+	deadline = loop.time() + budget
+	positions = len(review.moves) + 1
+	fen = review.startpos
+	game = ('review', id(review)) # keeps the engine warm without clearing its hash
+
+	for ply in range(positions):
+		if ply:
+			fen = sf.get_fen(review.variant, fen, [review.moves[ply - 1]], True)
+		white = fen.split()[1] == 'w'
+		review.white_to_move += [white]
+
+		remaining = deadline - loop.time()
+		if remaining <= 0:
+			break
+		movetime = int(min(max_movetime, 1000 * remaining / (positions - ply)))
+
+		# Wait for capacity between positions so bot moves go first, but not past the budget
+		try:
+			grant = await asyncio.wait_for(pool.scheduler.acquire(threads, memory, PRIORITY_REVIEW, owner), remaining) if pool.scheduler else None
+		except asyncio.TimeoutError:
+			break
+		try:
+			engine = await pool.acquire(review.variant, 20, grant.threads if grant else threads, grant.memory if grant else memory, game)
+		except BaseException:
+			if grant:
+				pool.scheduler.release(grant)
+			raise
+		engine.grant = grant
+		try:
+			analysis = await engine.analyze(fen, [], Limit(movetime=max(movetime, 10)))
+		finally:
+			await pool.release(engine) # returns the grant too
+
+		info = analysis.info()
+		review.add(white_cp(info.score, white) if info else 0)
+		if on_progress:
+			result = on_progress(review)
+			if asyncio.iscoroutine(result):
+				await result
+
+	review.finished = True
+	return review
@@ -1,3 +1,14 @@
+import json
+import os
+from hashlib import blake2b
+from re import findall
+
+import pyffish as sf
+
+SNAPSHOT_VERSION = 2
+SNAPSHOT_FIELDS = ('rules', 'start_fen', 'pieces') # everything taken from the ini
+
+
 class Variant:
 	def __init__(self, folder='chess', board_type='checkerboard', flip_pieces=False, intersections=False, invert_text=False, rules=''):
 		self.folder = folder
@@ -5,4 +16,52 @@ class Variant:
 		self.flip_pieces = flip_pieces
 		self.intersections = intersections
 		self.invert_text = invert_text
-		self.rules = rules
\ No newline at end of file
+		self.rules = rules
+
+		# filled in from variants.txt by load_registry
+		self.start_fen = None
+		self.pieces = '' # piece letters in the start position, pockets included, for preloading sprites
+		self.graphics_loaded = False # sprites decoded in this process
+
+	def describe(self, name):
+		self.start_fen = sf.start_fen(name)
+		board = self.start_fen.split()[0]
+		self.pieces = ''.join(sorted(set(findall('[A-Za-z]', board))))
+
+
+def ini_key(ini_text):
+	# Built-in variants can change between pyffish versions, so the version is part of the key
+	return blake2b(f"{sf.version()}\n{ini_text}".encode(), digest_size=16).hexdigest()
+
+
+def set_rules(variants, ini_text):
+	for definition in ini_text.split('\n\n'):
+		variant_name = findall("\[(.+?)[:|\]]", definition)[0]
+		variants[variant_name].rules = definition
+
+
+def load_registry(variants, ini_text, snapshot_file=None):
+	# Fills in the variants from the ini, which must already be loaded into pyffish.
+	# A snapshot made from the same ini and pyffish version is used instead, and rewritten when stale.
+	key = ini_key(ini_text)
+	if snapshot_file and os.path.isfile(snapshot_file):
+		with open(snapshot_file, 'r') as f:
+			snapshot = json.load(f)
+		if (snapshot.get('version') == SNAPSHOT_VERSION and snapshot.get('key') == key
+			and set(snapshot['variants']) == set(variants)):
+			for name, fields in snapshot['variants'].items():
+				for field in SNAPSHOT_FIELDS:
+					setattr(variants[name], field, fields[field])
+			return
+
+	set_rules(variants, ini_text)
+	for name, variant in variants.items():
+		variant.describe(name)
+
+	if snapshot_file:
+		snapshot = {'version': SNAPSHOT_VERSION,
+					'key': key,
+					'variants': {name: {field: getattr(variant, field) for field in SNAPSHOT_FIELDS}
+								 for name, variant in variants.items()}}
+		with open(snapshot_file, 'w') as f:
+			json.dump(snapshot, f)